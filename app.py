@@ -1,12 +1,32 @@
-from flask import Flask, render_template, request, send_from_directory, jsonify, Response, stream_with_context
+from flask import Flask, render_template, request, send_from_directory, jsonify, Response, stream_with_context, g, has_request_context
 import os
+import sys
 import requests
 import json
 import time
+import re
+import math
+import hashlib
+import hmac
+import sqlite3
+import threading
+import queue
+from collections import deque, OrderedDict
+import random
+import uuid
+import shutil
+import tarfile
+import zlib
+import cProfile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from dotenv import load_dotenv
-import anthropic
 from functools import lru_cache
 
+# The anthropic SDK is slow to import, so it is loaded on first use by get_anthropic_client()
+anthropic = None
+
 # Load environment variables
 load_dotenv()
 
@@ -18,33 +38,614 @@ os.makedirs('data', exist_ok=True)
 # Ollama configuration
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434/api")
 DEFAULT_OLLAMA_MODEL = "llama3.1:latest"
+OLLAMA_EMBED_MODEL = os.getenv("OLLAMA_EMBED_MODEL", "nomic-embed-text")
+
+# Embedding cache configuration (one .npy file per paragraph hash)
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", os.path.join("cache", "embeddings"))
+ALIGNMENT_THRESHOLD = float(os.getenv("ALIGNMENT_THRESHOLD", "0.6"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "128"))  # paragraphs per /embed request
 
 # Anthropic configuration
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
+ANTHROPIC_BASE_URL = os.getenv("ANTHROPIC_BASE_URL") or None  # e.g. a local stand-in server (batch_standin.py)
 DEFAULT_ANTHROPIC_MODEL = "claude-sonnet-4-5-20250929"
 
-# Initialize Anthropic client if API key is available
-anthropic_client = None
-if ANTHROPIC_API_KEY:
-    anthropic_client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+# Anthropic client, created on first use if an API key is available
+_anthropic_client = None
+_anthropic_lock = threading.Lock()
+
+# Shared cache (SQLite file, shared by every worker process on this host)
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH", os.path.join("cache", "shared.sqlite3"))
+CACHE_TTL = 300  # 5 minutes, for model lists
+HEALTH_CACHE_TTL = int(os.getenv("HEALTH_CACHE_TTL", "5"))
+GENERATION_CACHE_TTL = int(os.getenv("GENERATION_CACHE_TTL", "3600"))
+CACHE_PURGE_INTERVAL = 300  # seconds between sweeps of expired rows, per process
+STATS_TTL = 30 * 24 * 3600  # shared counters reported by /stats and /health
+
+# Request size limits
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(16 * 1024 * 1024)))  # form and JSON bodies
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(64 * 1024 * 1024)))    # streamed saves
+UPLOAD_CHUNK_SIZE = 64 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+app.config['MAX_FORM_MEMORY_SIZE'] = MAX_REQUEST_BYTES
+
+# Token budgeting (local estimates, checked before any provider call)
+DEFAULT_MAX_TOKENS = 4096
+MIN_OUTPUT_TOKENS = 256
+PROMPT_OVERHEAD_TOKENS = 16
+OLLAMA_MIN_NUM_CTX = int(os.getenv("OLLAMA_MIN_NUM_CTX", "4096"))
+OLLAMA_MAX_NUM_CTX = int(os.getenv("OLLAMA_MAX_NUM_CTX", "32768"))
+ANTHROPIC_MODEL_LIMITS = {
+    "claude-sonnet-4-5-20250929": {"context": 200000, "max_output": 64000},
+    "claude-opus-4-1-20250805": {"context": 200000, "max_output": 32000},
+    "claude-sonnet-4-20250514": {"context": 200000, "max_output": 64000}
+}
+DEFAULT_ANTHROPIC_LIMITS = {"context": 200000, "max_output": 8192}
+TOKEN_COUNT_CACHE_SIZE = 4096
+# The SDK refuses non-streaming calls whose max_tokens could run past 10 minutes
+ANTHROPIC_NON_STREAMING_MAX_TOKENS = 16000
+
+# Write-through of generated text into data/<name>/<name>_new.md
+WRITE_THROUGH_FLUSH_INTERVAL = float(os.getenv("WRITE_THROUGH_FLUSH_INTERVAL", "1.0"))  # seconds
+
+# Bulk export/import of data/
+EXPORT_CHUNK_SIZE = 256 * 1024
+MAX_IMPORT_BYTES = int(os.getenv("MAX_IMPORT_BYTES", str(1024 * 1024 * 1024)))  # 1 GB
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", "4"))
+
+# Admission control (host-wide: shared by every worker process through the shared cache)
+OLLAMA_MAX_CONCURRENT = int(os.getenv("OLLAMA_MAX_CONCURRENT", "2"))
+OLLAMA_MAX_QUEUE = int(os.getenv("OLLAMA_MAX_QUEUE", "8"))
+ANTHROPIC_MAX_CONCURRENT = int(os.getenv("ANTHROPIC_MAX_CONCURRENT", "8"))
+ANTHROPIC_MAX_QUEUE = int(os.getenv("ANTHROPIC_MAX_QUEUE", "32"))
+MAX_QUEUE_WAIT = float(os.getenv("MAX_QUEUE_WAIT", "30"))
+ADMISSION_POLL_INTERVAL = 0.25   # seconds between checks while waiting for a slot held by another worker
+ADMISSION_LEASE = 3600           # seconds before a slot whose holder never released it is reclaimed
+ADMISSION_PRUNE_INTERVAL = 5     # seconds between checks for slots held by dead worker processes
+
+# Request profiling
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_ALLOWLIST = {addr.strip() for addr in os.getenv("PROFILE_ALLOWLIST", "127.0.0.1,::1").split(",") if addr.strip()}
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # e.g. 0.001 profiles 1 request in 1000
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")                     # when set, X-Profile must carry this value
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))     # oldest .prof files beyond this are deleted
+
+# Ollama warm-up and keep-alive
+OLLAMA_PRELOAD_MODELS = [m.strip() for m in os.getenv("OLLAMA_PRELOAD_MODELS", "").split(",") if m.strip()]
+OLLAMA_WARMUP_INTERVAL = int(os.getenv("OLLAMA_WARMUP_INTERVAL", "60"))     # seconds between /tags and /ps polls
+OLLAMA_KEEP_ALIVE_MIN = int(os.getenv("OLLAMA_KEEP_ALIVE_MIN", "300"))      # seconds, for rarely used models
+OLLAMA_KEEP_ALIVE_MAX = int(os.getenv("OLLAMA_KEEP_ALIVE_MAX", "3600"))     # seconds, for busy models
+OLLAMA_WARM_ON_SELECT = os.getenv("OLLAMA_WARM_ON_SELECT", "true").lower() == "true"
+COLD_START_THRESHOLD = 0.5  # seconds of load_duration that count as a cold start
+
+# Incremental (paragraph-level) rewrites
+PARAGRAPH_CACHE_TTL = int(os.getenv("PARAGRAPH_CACHE_TTL", str(7 * 24 * 3600)))
+INCREMENTAL_CONTEXT_CHARS = int(os.getenv("INCREMENTAL_CONTEXT_CHARS", "600"))
+INCREMENTAL_GROUP_TOKENS = int(os.getenv("INCREMENTAL_GROUP_TOKENS", "2000"))  # changed paragraphs per request
+
+# Multi-model comparison
+COMPARE_MAX_TARGETS = int(os.getenv("COMPARE_MAX_TARGETS", "6"))
+COMPARE_EVENT_TIMEOUT = 300  # seconds of silence from every target before the stream gives up
+
+# Speculative pre-generation of commands for freshly loaded pairs
+SPECULATIVE_ENABLED = os.getenv("SPECULATIVE_ENABLED", "false").lower() == "true"
+SPECULATIVE_COMMANDS = [c.strip() for c in os.getenv("SPECULATIVE_COMMANDS", "summarize,improve").split(",") if c.strip()]
+SPECULATIVE_PROVIDERS = {p.strip() for p in os.getenv("SPECULATIVE_PROVIDERS", "ollama").split(",") if p.strip()}
+SPECULATIVE_MAX_PER_HOUR = int(os.getenv("SPECULATIVE_MAX_PER_HOUR", "30"))                # generations, all workers
+SPECULATIVE_MAX_TOKENS_PER_HOUR = int(os.getenv("SPECULATIVE_MAX_TOKENS_PER_HOUR", "200000"))
+SPECULATIVE_MAX_CHARS = int(os.getenv("SPECULATIVE_MAX_CHARS", "50000"))                    # skip larger documents
+SPECULATIVE_MAX_WAIT = int(os.getenv("SPECULATIVE_MAX_WAIT", "300"))  # seconds a job may wait for an idle provider
+SPECULATIVE_MAX_PENDING = 16
+SPECULATIVE_IDLE_POLL = 1.0
+
+# Offline bulk mode (Anthropic Message Batches)
+BATCH_POLL_INTERVAL = int(os.getenv("BATCH_POLL_INTERVAL", "60"))         # seconds between status polls
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "10000"))        # requests per submitted batch
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(100 * 1024 * 1024)))  # request body per submitted batch
+BATCH_JOB_TTL = int(os.getenv("BATCH_JOB_TTL", str(29 * 24 * 3600)))      # batch results are kept 29 days
+BATCH_LEASE_TTL = 600  # seconds before a lease held by a worker that died mid-poll runs out
+
+def get_anthropic_client():
+    """Return the Anthropic client, importing the SDK on first use (None if not configured)"""
+    global anthropic, _anthropic_client
+    if _anthropic_client is None and ANTHROPIC_API_KEY:
+        with _anthropic_lock:
+            if _anthropic_client is None:
+                import anthropic as anthropic_sdk
+                anthropic = anthropic_sdk
+                _anthropic_client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY, base_url=ANTHROPIC_BASE_URL)
+    return _anthropic_client
+
+# ============================================================================
+# SHARED CACHE
+# ============================================================================
+
+class SharedCache:
+    """Small TTL key/value store in SQLite so worker processes share one warm cache.
+
+    Values are stored as JSON. Each thread gets its own connection, and WAL
+    mode lets readers proceed while another worker writes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.last_purge = 0.0
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                " expires REAL NOT NULL, PRIMARY KEY (namespace, key))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS admission ("
+                " provider TEXT NOT NULL, owner TEXT NOT NULL, pid INTEGER NOT NULL,"
+                " state TEXT NOT NULL, since REAL NOT NULL, expires REAL NOT NULL,"
+                " PRIMARY KEY (provider, owner))"
+            )
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Run statements atomically with respect to other workers"""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def get(self, namespace, key):
+        row = self.connection().execute(
+            "SELECT value, expires FROM cache WHERE namespace = ? AND key = ?",
+            (namespace, key)
+        ).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0])
+
+    def set(self, namespace, key, value, ttl):
+        self.connection().execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+            (namespace, key, json.dumps(value), time.time() + ttl)
+        )
+        # Expired rows are only skipped on read, so sweep them out now and then
+        if time.time() - self.last_purge >= CACHE_PURGE_INTERVAL:
+            self.purge_expired()
+
+    def incr(self, namespace, key, amount, ttl):
+        """Atomically add amount to a numeric value (starting from 0 if missing or expired) and return it"""
+        now = time.time()
+        row = self.connection().execute(
+            "INSERT INTO cache (namespace, key, value, expires) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (namespace, key) DO UPDATE SET"
+            " value = CASE WHEN expires < ? THEN excluded.value"
+            " ELSE CAST(value + excluded.value AS TEXT) END,"
+            " expires = CASE WHEN expires < ? THEN excluded.expires ELSE expires END"
+            " RETURNING value",
+            (namespace, key, json.dumps(amount), now + ttl, now, now)
+        ).fetchone()
+        return json.loads(row[0])
+
+    def items(self, namespace):
+        """Return [(key, value)] for every unexpired entry in a namespace"""
+        rows = self.connection().execute(
+            "SELECT key, value FROM cache WHERE namespace = ? AND expires >= ?",
+            (namespace, time.time())
+        ).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def delete(self, namespace, key):
+        self.connection().execute(
+            "DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def purge_expired(self):
+        self.last_purge = time.time()
+        self.connection().execute("DELETE FROM cache WHERE expires < ?", (self.last_purge,))
+
+shared_cache = SharedCache(SHARED_CACHE_PATH)
+
+def generation_cache_key(provider, model, instruction, text, **params):
+    payload = json.dumps([provider, model, instruction, text, params], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def cache_stream(key, events):
+    """Pass stream events through, storing the assembled text in the generation cache when done"""
+    tokens = []
+    for event in events:
+        if 'token' in event:
+            tokens.append(event['token'])
+        if event.get('done') and key:
+            shared_cache.set('generation', key, {
+                "response": "".join(tokens),
+                "usage": event.get('usage', {}),
+                "chunks": event.get('chunks', 1)
+            }, GENERATION_CACHE_TTL)
+        yield event
+
+def request_cache_key(provider, model, instruction, text, data, **params):
+    """Generation cache key for a request body, covering every option that changes the output"""
+    return generation_cache_key(provider, model, instruction, text,
+                                max_tokens=data.get('max_tokens'),
+                                auto_chunk=bool(data.get('auto_chunk', False)),
+                                incremental=bool(data.get('incremental', False)), **params)
+
+def lookup_generation(provider, model, instruction, text, data, **params):
+    """Return (cache_key, cached_result) for a generation request.
+
+    The key is None when caching is disabled or the request opts out with "cache": false.
+    """
+    if GENERATION_CACHE_TTL <= 0 or not data.get('cache', True):
+        return None, None
+    key = request_cache_key(provider, model, instruction, text, data, **params)
+    cached = shared_cache.get('generation', key)
+    if cached and cached.pop('speculative', False):
+        speculator.record_hit(key, cached)
+    return key, cached
+
+def collect_events(events):
+    """Run a stream of events to completion and return the result a non-streaming endpoint sends"""
+    tokens = []
+    result = {}
+    for event in events:
+        if 'token' in event:
+            tokens.append(event['token'])
+        if event.get('done'):
+            result = {k: v for k, v in event.items() if k != 'done'}
+    return {"response": "".join(tokens), **result}
+
+def finish_generation(result, cache_key, save_to, write_mode):
+    """Cache and optionally write through a completed non-streaming generation"""
+    if cache_key:
+        shared_cache.set('generation', cache_key, result, GENERATION_CACHE_TTL)
+    if save_to:
+        save_generated(save_to, write_mode, result["response"])
+        return jsonify({"success": True, **result, "saved_to": save_to})
+    return jsonify({"success": True, **result})
+
+def replay_cached(cached):
+    """Stream events for a cached generation"""
+    yield {'token': cached['response']}
+    yield {'done': True, 'usage': cached.get('usage', {}), 'chunks': cached.get('chunks', 1), 'cached': True}
+
+# ============================================================================
+# REQUEST PROFILING
+# ============================================================================
+
+# cProfile can only have one active profiler per process
+_profile_lock = threading.Lock()
+
+@contextmanager
+def timed(category):
+    """Add the time spent in the block to the current request's Server-Timing category"""
+    if not has_request_context():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = g.setdefault('timings', {})
+        timings[category] = timings.get(category, 0.0) + time.perf_counter() - start
+
+def profiling_requested():
+    """Whether the client asked for a profile of this request and may have one.
+
+    Behind a reverse proxy every request comes from the proxy's address, so
+    the allowlist alone lets anyone through; set PROFILE_TOKEN there.
+    """
+    if request.remote_addr not in PROFILE_ALLOWLIST:
+        return False
+    flag = request.headers.get('X-Profile') or request.args.get('profile')
+    if PROFILE_TOKEN:
+        return hmac.compare_digest((flag or '').encode('utf-8'), PROFILE_TOKEN.encode('utf-8'))
+    return flag not in (None, '', '0', 'false')
+
+@app.before_request
+def start_request_timing():
+    g.request_start = time.perf_counter()
+    g.timings = {}
+    if profiling_requested() or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE):
+        if _profile_lock.acquire(blocking=False):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+def finish_profile(profiler, endpoint):
+    """Stop a request profiler and write its stats under PROFILE_DIR"""
+    try:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{os.getpid()}-{random.randrange(1 << 16):04x}.prof"
+        profiler.dump_stats(os.path.join(PROFILE_DIR, filename))
+        prune_profiles()
+        return filename
+    finally:
+        _profile_lock.release()
+
+def prune_profiles():
+    """Delete the oldest profiles so PROFILE_DIR holds at most PROFILE_MAX_FILES"""
+    paths = [entry.path for entry in os.scandir(PROFILE_DIR) if entry.name.endswith('.prof')]
+    if len(paths) <= PROFILE_MAX_FILES:
+        return
+    paths.sort(key=os.path.getmtime)
+    for path in paths[:len(paths) - PROFILE_MAX_FILES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # another worker removed it first
+
+@app.after_request
+def add_server_timing(response):
+    timings = g.get('timings', {})
+    total = time.perf_counter() - g.get('request_start', time.perf_counter())
+    compute = max(total - sum(timings.values()), 0.0)
+    parts = [f"{name};dur={value * 1000:.1f}" for name, value in sorted(timings.items())]
+    parts.append(f"compute;dur={compute * 1000:.1f}")
+    parts.append(f"total;dur={total * 1000:.1f}")
+    response.headers['Server-Timing'] = ", ".join(parts)
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        endpoint = (request.endpoint or 'unknown').replace('.', '_')
+        if response.is_streamed:
+            # Keep profiling while the body streams; the generator runs on this thread
+            response.call_on_close(lambda: finish_profile(profiler, endpoint))
+            response.headers['X-Profile'] = 'streaming'
+        else:
+            response.headers['X-Profile'] = finish_profile(profiler, endpoint)
+    return response
+
+@app.teardown_request
+def release_profiler(exc):
+    # after_request is skipped when a request fails hard; never leave the profiler lock held
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        finish_profile(profiler, (request.endpoint or 'unknown').replace('.', '_'))
+
+# ============================================================================
+# ADMISSION CONTROL
+# ============================================================================
+
+class Overloaded(Exception):
+    """A provider queue is full, or a request waited too long for a slot"""
+    def __init__(self, message, status, retry_after, queue_depth, provider):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.queue_depth = queue_depth
+        self.provider = provider
+
+class AdmissionSlot:
+    """A reserved generation slot; release() is safe to call more than once"""
+    def __init__(self, controller, owner):
+        self.controller = controller
+        self.owner = owner
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(self.owner, time.monotonic() - self.started)
+
+    def attach(self, response):
+        """Hold the slot until a (streaming) response has been fully sent or abandoned"""
+        response.call_on_close(self.release)
+        return response
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class AdmissionController:
+    """Bounded concurrency plus a bounded FIFO wait queue for one provider.
+
+    Requests beyond max_concurrent wait up to max_wait seconds for a slot;
+    once max_queue requests are already waiting, new ones are rejected
+    immediately instead of slowing down everyone in front of them.
+
+    Slots and waiters are rows in the shared SQLite store, so the limits
+    apply to the whole host rather than to each worker process. Waiters
+    check for a free slot in arrival order every ADMISSION_POLL_INTERVAL
+    seconds, or sooner when a slot in their own process is released. Rows
+    left behind by worker processes that died are reclaimed.
+    """
+    def __init__(self, provider, max_concurrent, max_queue, max_wait):
+        self.provider = provider
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        self.avg_service_s = 10.0  # moving average of slot hold time in this process
+        self.last_prune = 0.0
+
+    def retry_after(self, waiting):
+        # Time for the queue ahead to drain at the current service rate
+        backlog = waiting + 1
+        return max(1, math.ceil(backlog * self.avg_service_s / max(self.max_concurrent, 1)))
+
+    def counts(self, conn):
+        """(active, waiting) across all workers, dropping rows whose lease has run out"""
+        conn.execute("DELETE FROM admission WHERE provider = ? AND expires < ?", (self.provider, time.time()))
+        rows = dict(conn.execute(
+            "SELECT state, COUNT(*) FROM admission WHERE provider = ? GROUP BY state", (self.provider,)
+        ).fetchall())
+        return rows.get('active', 0), rows.get('waiting', 0)
+
+    def prune_dead(self):
+        """Release slots and queue places held by worker processes that no longer exist"""
+        if sys.platform == 'win32' or time.monotonic() - self.last_prune < ADMISSION_PRUNE_INTERVAL:
+            return
+        self.last_prune = time.monotonic()
+        conn = shared_cache.connection()
+        pids = [row[0] for row in conn.execute(
+            "SELECT DISTINCT pid FROM admission WHERE provider = ? AND pid != ?", (self.provider, os.getpid()))]
+        for pid in pids:
+            if not process_alive(pid):
+                conn.execute("DELETE FROM admission WHERE provider = ? AND pid = ?", (self.provider, pid))
+
+    def take(self, owner, mode):
+        """Make owner an active slot if the rules for mode allow it right now.
+
+        "new" needs a free slot and an empty queue, "waiter" needs a free slot
+        and owner at the head of the queue, "idle" needs nothing else running.
+        """
+        with shared_cache.transaction() as conn:
+            active, waiting = self.counts(conn)
+            if active >= self.max_concurrent:
+                return False
+            if mode == 'waiter':
+                head = conn.execute(
+                    "SELECT owner FROM admission WHERE provider = ? AND state = 'waiting'"
+                    " ORDER BY since LIMIT 1", (self.provider,)
+                ).fetchone()
+                if head and head[0] != owner:
+                    return False
+            elif waiting or (mode == 'idle' and active):
+                return False
+            now = time.time()
+            conn.execute(
+                "INSERT OR REPLACE INTO admission (provider, owner, pid, state, since, expires)"
+                " VALUES (?, ?, ?, 'active', ?, ?)",
+                (self.provider, owner, os.getpid(), now, now + ADMISSION_LEASE)
+            )
+            return True
+
+    def count(self, name):
+        shared_cache.incr('admission', f"{self.provider}:{name}", 1, STATS_TTL)
+
+    def acquire(self):
+        owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+        self.prune_dead()
+        if self.take(owner, 'new'):
+            return AdmissionSlot(self, owner)
+
+        with shared_cache.transaction() as conn:
+            _, waiting = self.counts(conn)
+            queue_full = waiting >= self.max_queue
+            if not queue_full:
+                now = time.time()
+                conn.execute(
+                    "INSERT INTO admission (provider, owner, pid, state, since, expires)"
+                    " VALUES (?, ?, ?, 'waiting', ?, ?)",
+                    (self.provider, owner, os.getpid(), now, now + self.max_wait + ADMISSION_LEASE)
+                )
+        if queue_full:
+            self.count('rejected')
+            raise Overloaded(f"{self.provider} is at capacity, please retry shortly",
+                             429, self.retry_after(waiting), waiting, self.provider)
+
+        deadline = time.monotonic() + self.max_wait
+        try:
+            while True:
+                self.prune_dead()
+                if self.take(owner, 'waiter'):
+                    return AdmissionSlot(self, owner)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                with self.condition:
+                    self.condition.wait(min(remaining, ADMISSION_POLL_INTERVAL))
+        except BaseException:
+            shared_cache.connection().execute(
+                "DELETE FROM admission WHERE provider = ? AND owner = ?", (self.provider, owner))
+            raise
+
+        shared_cache.connection().execute(
+            "DELETE FROM admission WHERE provider = ? AND owner = ?", (self.provider, owner))
+        self.count('timed_out')
+        _, waiting = self.counts(shared_cache.connection())
+        raise Overloaded(f"Timed out waiting for a {self.provider} slot",
+                         503, self.retry_after(waiting), waiting, self.provider)
+
+    def release(self, owner, duration):
+        shared_cache.connection().execute(
+            "DELETE FROM admission WHERE provider = ? AND owner = ?", (self.provider, owner))
+        with self.condition:
+            self.avg_service_s = 0.8 * self.avg_service_s + 0.2 * duration
+            self.condition.notify_all()
+
+    def is_idle(self):
+        self.prune_dead()
+        return self.counts(shared_cache.connection()) == (0, 0)
+
+    def acquire_if_idle(self):
+        """Take a slot only if nothing else is running or waiting on any worker; for background work"""
+        owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+        self.prune_dead()
+        return AdmissionSlot(self, owner) if self.take(owner, 'idle') else None
+
+    def snapshot(self):
+        self.prune_dead()
+        active, waiting = self.counts(shared_cache.connection())
+        return {
+            "active": active,
+            "queued": waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "saturation": round((active + waiting) / max(self.max_concurrent + self.max_queue, 1), 3),
+            "queue_full": waiting >= self.max_queue,
+            "rejected": shared_cache.get('admission', f"{self.provider}:rejected") or 0,
+            "timed_out": shared_cache.get('admission', f"{self.provider}:timed_out") or 0,
+            "avg_service_s": round(self.avg_service_s, 2)
+        }
 
-# Cache for model lists (5 minute TTL)
-model_cache = {
-    'ollama': {'models': [], 'timestamp': 0},
-    'anthropic': {'models': [], 'timestamp': 0}
+admission = {
+    'ollama': AdmissionController('ollama', OLLAMA_MAX_CONCURRENT, OLLAMA_MAX_QUEUE, MAX_QUEUE_WAIT),
+    'anthropic': AdmissionController('anthropic', ANTHROPIC_MAX_CONCURRENT, ANTHROPIC_MAX_QUEUE, MAX_QUEUE_WAIT)
 }
-CACHE_TTL = 300  # 5 minutes
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    response = jsonify({
+        "success": False,
+        "message": str(e),
+        "provider": e.provider,
+        "queue_depth": e.queue_depth,
+        "retry_after": e.retry_after
+    })
+    response.status_code = e.status
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+# ============================================================================
+# CORE ROUTES
+# ============================================================================
+
+def list_pair_files():
+    """List saved pairs as "<name>.md", one per folder that has an original text"""
+    files = []
+    with timed('io'):
+        with os.scandir('data') as entries:
+            for entry in entries:
+                # Check if this is a valid text pair folder
+                if entry.is_dir() and os.path.exists(os.path.join(entry.path, f"{entry.name}_original.md")):
+                    files.append(entry.name + '.md')  # Add .md extension for consistency
+    return files
 
 @app.route('/')
 def index():
-    files = []
-    for item in os.listdir('data'):
-        item_path = os.path.join('data', item)
-        if os.path.isdir(item_path):
-            # Check if this is a valid text pair folder
-            original_filename = f"{item}_original.md"
-            if os.path.exists(os.path.join(item_path, original_filename)):
-                files.append(item + '.md')  # Add .md extension for consistency
+    files = list_pair_files()
     return render_template('index.html',
                          title="TextCompare",
                          files=files,
@@ -66,14 +667,174 @@ def save():
     new_filename = f"{folder_name}_new.md"
 
     # Save both texts to files in the folder
-    with open(os.path.join(folder_path, original_filename), 'w', encoding='utf-8') as f:
-        f.write(original_text)
-
-    with open(os.path.join(folder_path, new_filename), 'w', encoding='utf-8') as f:
-        f.write(new_text)
+    with timed('io'):
+        write_file_atomic(os.path.join(folder_path, original_filename), original_text)
+        write_file_atomic(os.path.join(folder_path, new_filename), new_text)
 
     return {'success': True, 'message': f'Saved as {filename}'}
 
+def write_file_atomic(path, content):
+    """Write str or bytes to path via a temp file, so readers never see a half-written file"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if isinstance(content, bytes):
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+    else:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+    os.replace(tmp_path, path)
+
+class UploadTooLarge(Exception):
+    """Streamed body exceeded MAX_UPLOAD_BYTES"""
+
+def write_stream_atomic(path, stream, limit):
+    """Copy a binary stream to path in chunks, replacing the file only once the copy is complete"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    written = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > limit:
+                    raise UploadTooLarge(f"Upload exceeds the {limit}-byte limit")
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return written
+
+@app.route('/save/stream', methods=['PUT', 'POST'])
+def save_stream():
+    """Stream the raw request body to one side of a pair without buffering it in memory.
+
+    Query parameters: filename (pair name) and side ("original" or "new").
+    """
+    # Streamed saves get their own, larger limit than form and JSON bodies
+    request.max_content_length = MAX_UPLOAD_BYTES
+
+    filename = request.args.get('filename', 'untitled.md')
+    side = request.args.get('side', 'original')
+    if side not in ('original', 'new'):
+        return {'success': False, 'message': 'side must be "original" or "new"'}, 400
+
+    try:
+        folder_name, folder_path = get_pair_folder(filename)
+    except ValueError as e:
+        return {'success': False, 'message': str(e)}, 400
+
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES:
+        return {'success': False, 'message': f'Upload exceeds the {MAX_UPLOAD_BYTES}-byte limit'}, 413
+
+    os.makedirs(folder_path, exist_ok=True)
+    try:
+        with timed('io'):
+            written = write_stream_atomic(
+                os.path.join(folder_path, f"{folder_name}_{side}.md"), request.stream, MAX_UPLOAD_BYTES)
+    except UploadTooLarge as e:
+        return {'success': False, 'message': str(e)}, 413
+
+    return {'success': True, 'message': f'Saved {side} text of {filename}', 'bytes': written}
+
+class PairWriter:
+    """Persist generated text into a pair's _new.md as it streams.
+
+    Tokens go to a .partial file next to the target, flushed every
+    WRITE_THROUGH_FLUSH_INTERVAL seconds, and the target is only replaced
+    once the generation completes. In append mode the existing text is
+    copied into the partial file first, so the swap stays atomic.
+    """
+    def __init__(self, filename, mode='replace'):
+        if mode not in ('replace', 'append'):
+            raise ValueError('write_mode must be "replace" or "append"')
+        folder_name, folder_path = get_pair_folder(filename)
+        os.makedirs(folder_path, exist_ok=True)
+        self.filename = filename
+        self.path = os.path.join(folder_path, f"{folder_name}_new.md")
+        self.partial_path = f"{self.path}.{os.getpid()}-{threading.get_ident()}.partial"
+        self.file = open(self.partial_path, 'w', encoding='utf-8')
+        if mode == 'append' and os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as existing:
+                shutil.copyfileobj(existing, self.file)
+            if self.file.tell():
+                self.file.write('\n\n')
+        self.last_flush = time.monotonic()
+
+    def write(self, text):
+        self.file.write(text)
+        now = time.monotonic()
+        if now - self.last_flush >= WRITE_THROUGH_FLUSH_INTERVAL:
+            self.file.flush()
+            self.last_flush = now
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.partial_path, self.path)
+
+    def abort(self):
+        # Leave the .partial file in place so interrupted output can be recovered
+        self.file.close()
+
+def get_write_through(data):
+    """Return (save_to, write_mode) from a generation request, validating both"""
+    save_to = data.get('save_to')
+    mode = data.get('write_mode', 'replace')
+    if save_to:
+        get_pair_folder(save_to)
+        if mode not in ('replace', 'append'):
+            raise ValueError('write_mode must be "replace" or "append"')
+    return save_to, mode
+
+def save_generated(filename, mode, text):
+    """Write a complete (non-streamed) generation into a pair's _new.md"""
+    with timed('io'):
+        writer = PairWriter(filename, mode)
+        writer.write(text)
+        writer.commit()
+
+def write_through(events, filename, mode):
+    """Pass stream events through while persisting their tokens into a pair's _new.md.
+
+    If the client disconnects mid-stream the remaining events are still
+    drained into the file, so closing the tab does not lose the output.
+    """
+    writer = PairWriter(filename, mode)
+    completed = False
+    try:
+        try:
+            for event in events:
+                if 'token' in event:
+                    writer.write(event['token'])
+                if event.get('done'):
+                    completed = True
+                    writer.commit()
+                    event = {**event, 'saved_to': filename}
+                yield event
+        except GeneratorExit:
+            for event in events:
+                if 'token' in event:
+                    writer.write(event['token'])
+                if event.get('done'):
+                    completed = True
+                    writer.commit()
+            raise
+    finally:
+        if not completed:
+            writer.abort()
+
+@app.errorhandler(413)
+def request_too_large(e):
+    # Streaming routes raise their own per-request limit, so report whichever applied
+    message = f"Request exceeds the {request.max_content_length}-byte limit."
+    if request.endpoint not in ('save_stream', 'import_pairs'):
+        message += " Use /save/stream for large documents."
+    return jsonify({"success": False, "message": message}), 413
+
 @app.route('/load', methods=['POST'])
 def load():
     filename = request.form.get('filename', '')
@@ -90,76 +851,571 @@ def load():
         original_filename = f"{folder_name}_original.md"
         new_filename = f"{folder_name}_new.md"
 
-        with open(os.path.join(folder_path, original_filename), 'r', encoding='utf-8') as f:
-            original_content = f.read()
+        with timed('io'):
+            with open(os.path.join(folder_path, original_filename), 'r', encoding='utf-8') as f:
+                original_content = f.read()
 
-        try:
-            with open(os.path.join(folder_path, new_filename), 'r', encoding='utf-8') as f:
-                new_content = f.read()
-        except:
-            # It's okay if the new file doesn't exist yet
-            pass
+            try:
+                with open(os.path.join(folder_path, new_filename), 'r', encoding='utf-8') as f:
+                    new_content = f.read()
+            except:
+                # It's okay if the new file doesn't exist yet
+                pass
+
+        # Precompute likely next commands with the model the user has selected
+        speculating = speculator.schedule(request.form.get('provider'), request.form.get('model'), filename)
 
-        return {'success': True, 'original_text': original_content, 'new_text': new_content}
+        return {'success': True, 'original_text': original_content, 'new_text': new_content,
+                'speculating': speculating}
     except:
         return {'success': False, 'message': 'File not found'}
 
 @app.route('/list_files')
 def list_files():
-    files = []
-    for item in os.listdir('data'):
-        item_path = os.path.join('data', item)
-        if os.path.isdir(item_path):
-            # Check if this is a valid text pair folder
-            original_filename = f"{item}_original.md"
-            if os.path.exists(os.path.join(item_path, original_filename)):
-                files.append(item + '.md')  # Add .md extension for consistency
-    return {'files': files}
+    return {'files': list_pair_files()}
+
+# ============================================================================
+# BULK EXPORT / IMPORT
+# ============================================================================
+
+PAIR_MEMBER_PATTERN = re.compile(r'^([^/\\]+)/\1_(original|new)\.md$')
+
+def valid_member_pair(name):
+    """True if an archive's pair folder name is safe to write under data/ on any platform"""
+    try:
+        return get_pair_folder(f"{name}.md")[0] == name
+    except ValueError:
+        return False
+
+def tar_member_header(name, size, mtime):
+    info = tarfile.TarInfo(name=name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT)
+
+def tar_padding(size):
+    remainder = size % tarfile.BLOCKSIZE
+    return b'\0' * (tarfile.BLOCKSIZE - remainder) if remainder else b''
+
+def export_stream(pairs):
+    """Yield a tar archive of the given pairs chunk by chunk, ending with manifest.json.
+
+    Both files of a pair are opened before either is read. Saves replace files
+    atomically, so each pair is exported as a consistent snapshot even while
+    the server keeps writing. Hashes in the manifest are taken from the bytes
+    actually streamed.
+    """
+    manifest = {"format": 1, "created": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), "pairs": []}
+
+    for filename in pairs:
+        folder_name, folder_path = get_pair_folder(filename)
+        handles = []
+        for side in ('original', 'new'):
+            try:
+                handles.append((side, open(os.path.join(folder_path, f"{folder_name}_{side}.md"), 'rb')))
+            except FileNotFoundError:
+                continue
+        if not handles:
+            continue
+
+        entry = {"name": folder_name, "files": {}}
+        try:
+            for side, handle in handles:
+                stat = os.fstat(handle.fileno())
+                member = f"{folder_name}/{folder_name}_{side}.md"
+                yield tar_member_header(member, stat.st_size, stat.st_mtime)
+
+                digest = hashlib.sha256()
+                remaining = stat.st_size
+                while remaining > 0:
+                    chunk = handle.read(min(EXPORT_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        # Cannot happen for an atomically replaced file; keep the archive valid anyway
+                        chunk = b'\0' * remaining
+                    remaining -= len(chunk)
+                    digest.update(chunk)
+                    yield chunk
+                yield tar_padding(stat.st_size)
+
+                entry["files"][side] = {"size": stat.st_size, "sha256": digest.hexdigest()}
+        finally:
+            for _, handle in handles:
+                handle.close()
+        manifest["pairs"].append(entry)
+
+    manifest["count"] = len(manifest["pairs"])
+    manifest_bytes = json.dumps(manifest, indent=2).encode('utf-8')
+    yield tar_member_header("manifest.json", len(manifest_bytes), time.time())
+    yield manifest_bytes
+    yield tar_padding(len(manifest_bytes))
+    # End-of-archive marker: two empty blocks
+    yield b'\0' * (2 * tarfile.BLOCKSIZE)
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route('/export')
+def export_pairs():
+    """Stream a tar (or tar.gz) archive of saved pairs without staging it in memory or on disk.
+
+    Query parameters: pairs (comma-separated names, default all) and
+    compress=gzip.
+    """
+    requested = [p for p in request.args.get('pairs', '').split(',') if p.strip()]
+    available = list_pair_files()
+    if requested:
+        try:
+            pairs = [f"{get_pair_folder(p.strip())[0]}.md" for p in requested]
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 400
+        missing = sorted(set(pairs) - set(available))
+        if missing:
+            return jsonify({"success": False, "message": f"File not found: {', '.join(missing)}"}), 404
+    else:
+        pairs = sorted(available)
+
+    chunks = export_stream(pairs)
+    filename = f"textcompare-export-{time.strftime('%Y%m%d-%H%M%S')}.tar"
+    mimetype = 'application/x-tar'
+    if request.args.get('compress') == 'gzip':
+        chunks = gzip_stream(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+
+    return Response(chunks, mimetype=mimetype, direct_passthrough=True, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'X-Pair-Count': str(len(pairs))
+    })
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(EXPORT_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def spool_member(path, stream):
+    """Copy an archive member to a temp file next to path in chunks; returns (tmp_path, sha256)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest()
+
+def import_member(path, tmp_path, content_hash, overwrite):
+    """Move a spooled member into place unless identical content is already there; returns the outcome"""
+    try:
+        if os.path.exists(path):
+            if file_sha256(path) == content_hash:
+                return 'unchanged'
+            if not overwrite:
+                return 'conflict'
+        os.replace(tmp_path, path)
+        return 'written'
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+@app.route('/import', methods=['POST', 'PUT'])
+def import_pairs():
+    """Import a tar or tar.gz archive (as produced by /export) streamed in the request body.
+
+    Members are copied one at a time from the stream to temp files in
+    chunks (hashing as they go), and a small thread pool compares them with
+    what is stored and moves them into place. Members larger than
+    MAX_UPLOAD_BYTES are skipped. Files whose content hash matches what is already stored, or
+    an earlier member of the same archive, are skipped. Existing files with
+    different content are kept unless on_conflict=overwrite.
+    """
+    request.max_content_length = MAX_IMPORT_BYTES
+    overwrite = request.args.get('on_conflict', 'skip') == 'overwrite'
+
+    results = {"written": 0, "unchanged": 0, "conflict": 0, "duplicate": 0, "ignored": 0, "too_large": 0}
+    conflicts = []
+    too_large = []
+    manifest = None
+    seen = {}
+    pending = []
+    in_flight = threading.BoundedSemaphore(IMPORT_WORKERS * 2)
+
+    def write(path, tmp_path, content_hash):
+        try:
+            return path, import_member(path, tmp_path, content_hash, overwrite)
+        finally:
+            in_flight.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as executor:
+            with tarfile.open(fileobj=request.stream, mode='r|*') as archive:
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    if member.name == 'manifest.json' and member.size <= MAX_REQUEST_BYTES:
+                        manifest = json.load(archive.extractfile(member))
+                        continue
+                    match = PAIR_MEMBER_PATTERN.match(member.name)
+                    if not match or not valid_member_pair(match.group(1)):
+                        results["ignored"] += 1
+                        continue
+                    # Same per-file limit as /save/stream
+                    if member.size > MAX_UPLOAD_BYTES:
+                        results["too_large"] += 1
+                        too_large.append(member.name)
+                        continue
+
+                    path = os.path.join('data', member.name)
+                    tmp_path, content_hash = spool_member(path, archive.extractfile(member))
+                    if seen.get(member.name) == content_hash:
+                        os.remove(tmp_path)
+                        results["duplicate"] += 1
+                        continue
+                    seen[member.name] = content_hash
+
+                    # Bound how many spooled files wait while writers catch up
+                    in_flight.acquire()
+                    pending.append(executor.submit(write, path, tmp_path, content_hash))
+
+            for future in pending:
+                path, outcome = future.result()
+                results[outcome] += 1
+                if outcome == 'conflict':
+                    conflicts.append(os.path.relpath(path, 'data'))
+    except tarfile.TarError as e:
+        return jsonify({"success": False, "message": f"Invalid archive: {str(e)}", **results}), 400
+    except OSError as e:
+        return jsonify({"success": False, "message": f"Error writing imported files: {str(e)}", **results}), 500
+
+    response = {"success": True, **results, "conflicts": conflicts, "too_large_files": too_large}
+    if manifest is not None:
+        response["manifest_pairs"] = manifest.get("count")
+    return jsonify(response)
+
+# ============================================================================
+# TOKEN BUDGETING
+# ============================================================================
+
+class PreflightError(Exception):
+    """Raised when a prompt cannot fit the selected model's context window"""
+    def __init__(self, message, plan):
+        super().__init__(message)
+        self.plan = plan
+
+# Token estimates by text hash, shared by all request threads
+token_count_cache = OrderedDict()
+_token_count_lock = threading.Lock()
+
+def count_tokens(text):
+    """Estimate the token count of text locally, cached by text hash.
+
+    Uses the larger of a character-based (~4 chars/token) and a word-based
+    (~0.75 words/token) estimate, which errs on the high side for both prose
+    and code so the budget check never under-reserves.
+    """
+    if not text:
+        return 0
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    with _token_count_lock:
+        count = token_count_cache.get(key)
+    if count is None:
+        count = max(math.ceil(len(text) / 4), math.ceil(len(text.split()) * 4 / 3))
+        with _token_count_lock:
+            token_count_cache[key] = count
+            if len(token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+                token_count_cache.popitem(last=False)
+    return count
+
+def get_model_limits(provider, model):
+    """Return the context window and output cap for a model"""
+    if provider == 'anthropic':
+        return ANTHROPIC_MODEL_LIMITS.get(model, DEFAULT_ANTHROPIC_LIMITS)
+    return {"context": OLLAMA_MAX_NUM_CTX, "max_output": OLLAMA_MAX_NUM_CTX // 2}
+
+def preflight(provider, model, instruction, text, max_tokens=None):
+    """Check a generation request against the model's limits before dispatching it.
+
+    Picks max_tokens (and num_ctx for Ollama) from the estimated prompt size.
+    The request fits when the context left after the prompt holds at least
+    MIN_OUTPUT_TOKENS, or the caller's own max_tokens if that is smaller.
+    When the prompt does not fit, the plan carries the text split into chunks
+    that do.
+    """
+    limits = get_model_limits(provider, model)
+    instruction_tokens = count_tokens(instruction)
+    text_tokens = count_tokens(text)
+    prompt_tokens = instruction_tokens + text_tokens + PROMPT_OVERHEAD_TOKENS
+    available = limits['context'] - prompt_tokens
+
+    if max_tokens is None:
+        # Rewrites are roughly as long as their input, so leave some headroom
+        max_tokens = max(DEFAULT_MAX_TOKENS, int(text_tokens * 1.5))
+        min_tokens = MIN_OUTPUT_TOKENS
+    else:
+        max_tokens = max(int(max_tokens), 1)
+        min_tokens = min(max_tokens, MIN_OUTPUT_TOKENS)
+    max_tokens = min(max_tokens, limits['max_output'], available)
+
+    plan = {
+        "provider": provider,
+        "model": model,
+        "prompt_tokens": prompt_tokens,
+        "max_tokens": max(max_tokens, 0),
+        "context_window": limits['context'],
+        "fits": available >= min_tokens
+    }
+
+    if provider == 'ollama':
+        # Ollama reloads the model whenever num_ctx changes, so only use
+        # power-of-two sizes to keep the number of distinct values small
+        num_ctx = OLLAMA_MIN_NUM_CTX
+        while num_ctx < prompt_tokens + plan['max_tokens'] and num_ctx < OLLAMA_MAX_NUM_CTX:
+            num_ctx *= 2
+        plan['num_ctx'] = min(num_ctx, OLLAMA_MAX_NUM_CTX)
+
+    if not plan['fits']:
+        chunk_budget = int(min(
+            (limits['context'] - instruction_tokens - PROMPT_OVERHEAD_TOKENS) / 2.5,
+            limits['max_output'] / 1.5
+        ))
+        plan['chunks'] = chunk_text(text, chunk_budget) if chunk_budget > 0 else []
+
+    return plan
+
+def chunk_text(text, max_tokens):
+    """Split text into chunks of at most max_tokens, breaking on paragraphs where possible"""
+    chunks = []
+    current = []
+    current_tokens = 0
+    for paragraph in split_paragraphs(text):
+        pieces = [paragraph]
+        if count_tokens(paragraph) > max_tokens:
+            # Oversize paragraph: fall back to fixed-size character slices
+            size = max_tokens * 3
+            pieces = [paragraph[i:i + size] for i in range(0, len(paragraph), size)]
+        for piece in pieces:
+            piece_tokens = count_tokens(piece)
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append("\n\n".join(current))
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+def plan_generation(provider, model, instruction, text, max_tokens=None, auto_chunk=False):
+    """Return a list of (text, plan) pieces to send, or raise PreflightError"""
+    plan = preflight(provider, model, instruction, text, max_tokens)
+    if plan['fits']:
+        return [(text, plan)]
+    if not auto_chunk or not plan.get('chunks'):
+        raise PreflightError(
+            f"Prompt is about {plan['prompt_tokens']} tokens, which does not fit the "
+            f"{plan['context_window']}-token context of {model}. "
+            "Shorten the text or enable auto_chunk.",
+            plan
+        )
+    pieces = [(chunk, preflight(provider, model, instruction, chunk, max_tokens))
+              for chunk in plan['chunks']]
+    for index, (_, chunk_plan) in enumerate(pieces, 1):
+        if not chunk_plan['fits']:
+            raise PreflightError(
+                f"Chunk {index} of {len(pieces)} is still about {chunk_plan['prompt_tokens']} tokens, "
+                f"which does not fit the {chunk_plan['context_window']}-token context of {model}. "
+                "Shorten the instruction or the text.",
+                plan
+            )
+    return pieces
+
+def get_generation_data():
+    """Return the JSON body of a generation request.
+
+    If it names a saved pair ("pair", optionally "side": "new"), the text is
+    read from disk instead of being uploaded again.
+    """
+    data = dict(request.json or {})
+    if data.get('pair'):
+        try:
+            original_text, new_text = read_pair(data['pair'])
+        except FileNotFoundError:
+            raise ValueError(f"File not found: {data['pair']}")
+        data['text'] = (new_text if data.get('side') == 'new' else original_text).strip()
+    return data
+
+def build_prompt(instruction, text):
+    return f"{instruction}\n\n{text}"
+
+def merge_usage(total, usage):
+    for key in ('input_tokens', 'output_tokens'):
+        total[key] = total.get(key, 0) + (usage or {}).get(key, 0)
+    return total
+
+def preflight_summary(plan):
+    """Plan without the chunk texts, for JSON responses"""
+    summary = {k: v for k, v in plan.items() if k != 'chunks'}
+    if 'chunks' in plan:
+        summary['chunk_count'] = len(plan['chunks'])
+    return summary
+
+@app.route('/count_tokens', methods=['POST'])
+def count_tokens_endpoint():
+    """Estimate prompt tokens and the generation budget without calling a provider"""
+    data = request.json or {}
+    provider = data.get('provider', 'ollama')
+    default_model = DEFAULT_ANTHROPIC_MODEL if provider == 'anthropic' else DEFAULT_OLLAMA_MODEL
+    plan = preflight(
+        provider,
+        data.get('model', default_model),
+        data.get('instruction', 'Rewrite the following text:'),
+        data.get('text', ''),
+        data.get('max_tokens')
+    )
+    return jsonify({"success": True, **preflight_summary(plan)})
 
 # ============================================================================
 # OLLAMA ENDPOINTS
 # ============================================================================
 
-@app.route('/ollama', methods=['POST'])
-def ollama_generate():
-    """Generate text using Ollama (non-streaming)"""
+class OllamaError(Exception):
+    """Non-200 response from the Ollama API"""
+
+def ollama_error_message(response):
+    error_msg = f"Ollama API error: {response.status_code}"
     try:
-        data = request.json
-        text = data.get('text', '')
-        instruction = data.get('instruction', 'Rewrite the following text:')
-        model = data.get('model', DEFAULT_OLLAMA_MODEL)
+        error_detail = response.json()
+        error_msg += f" - {error_detail.get('error', '')}"
+    except:
+        pass
+    return error_msg
 
-        # Format the prompt
-        prompt = f"{instruction}\n\n{text}"
+def ollama_options(plan):
+    return {"num_ctx": plan['num_ctx'], "num_predict": plan['max_tokens']}
 
-        # Call Ollama API with increased timeout
+def ollama_usage(result):
+    return {
+        "input_tokens": result.get("prompt_eval_count", 0),
+        "output_tokens": result.get("eval_count", 0)
+    }
+
+def ollama_complete(model, prompt, options=None):
+    """Call Ollama without streaming and return (text, usage)"""
+    ollama_warmup.touch(model)
+    with timed('upstream'):
         response = requests.post(
             f"{OLLAMA_BASE_URL}/generate",
             json={
                 "model": model,
                 "prompt": prompt,
-                "stream": False
+                "stream": False,
+                "options": options or {},
+                "keep_alive": ollama_warmup.keep_alive(model)
             },
             timeout=120  # Increased timeout to 2 minutes
         )
+    if response.status_code != 200:
+        raise OllamaError(ollama_error_message(response))
+    result = response.json()
+    ollama_warmup.record_load(model, result)
+    return result.get("response", ""), ollama_usage(result)
+
+def ollama_stream_events(model, prompt, options=None):
+    """Call Ollama with streaming, yielding {'token': ...} and a final {'done': True, 'usage': ...}"""
+    ollama_warmup.touch(model)
+    with timed('upstream'):
+        response = requests.post(
+            f"{OLLAMA_BASE_URL}/generate",
+            json={
+                "model": model,
+                "prompt": prompt,
+                "stream": True,
+                "options": options or {},
+                "keep_alive": ollama_warmup.keep_alive(model)
+            },
+            stream=True,
+            timeout=120
+        )
+    if response.status_code != 200:
+        raise OllamaError(ollama_error_message(response))
 
-        if response.status_code == 200:
-            result = response.json()
-            return jsonify({
-                "success": True,
-                "response": result.get("response", "")
-            })
-        else:
-            error_msg = f"Ollama API error: {response.status_code}"
+    for line in response.iter_lines():
+        if line:
             try:
-                error_detail = response.json()
-                error_msg += f" - {error_detail.get('error', '')}"
-            except:
-                pass
-            return jsonify({
-                "success": False,
-                "message": error_msg
-            })
+                chunk = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if chunk.get('response'):
+                yield {'token': chunk['response']}
+            if chunk.get('done', False):
+                ollama_warmup.record_load(model, chunk)
+                yield {'done': True, 'usage': ollama_usage(chunk)}
+
+def sse(event):
+    return f"data: {json.dumps(event)}\n\n"
+
+def sse_response(events):
+    """Server-sent event response for an iterable of event dicts"""
+    return Response(stream_with_context(sse(event) for event in events), mimetype='text/event-stream')
+
+def stream_pieces(pieces, stream_fn):
+    """Stream a list of (text, plan) pieces one after another as a single response"""
+    usage = {}
+    for index, (piece, plan) in enumerate(pieces):
+        if index:
+            yield {'token': '\n\n'}
+        for event in stream_fn(piece, plan):
+            if event.get('done'):
+                merge_usage(usage, event.get('usage'))
+            else:
+                yield event
+    yield {'done': True, 'usage': usage, 'chunks': len(pieces)}
+
+@app.route('/ollama', methods=['POST'])
+def ollama_generate():
+    """Generate text using Ollama (non-streaming)"""
+    try:
+        data = get_generation_data()
+        text = data.get('text', '')
+        instruction = data.get('instruction', 'Rewrite the following text:')
+        model = data.get('model', DEFAULT_OLLAMA_MODEL)
+
+        save_to, write_mode = get_write_through(data)
+
+        cache_key, cached = lookup_generation('ollama', model, instruction, text, data)
+        if cached:
+            if save_to:
+                save_generated(save_to, write_mode, cached["response"])
+                return jsonify({"success": True, **cached, "cached": True, "saved_to": save_to})
+            return jsonify({"success": True, **cached, "cached": True})
+
+        with admission['ollama'].acquire():
+            result = compute_generation('ollama', model, instruction, text, data)
+        return finish_generation(result, cache_key, save_to, write_mode)
+    except Overloaded:
+        raise
+    except PreflightError as e:
+        return jsonify({
+            "success": False,
+            "message": str(e),
+            "preflight": preflight_summary(e.plan)
+        })
+    except OllamaError as e:
+        return jsonify({
+            "success": False,
+            "message": str(e)
+        })
     except requests.exceptions.Timeout:
         return jsonify({
             "success": False,
@@ -179,68 +1435,73 @@ def ollama_generate():
 @app.route('/ollama/stream', methods=['POST'])
 def ollama_stream():
     """Generate text using Ollama with streaming"""
-    def generate():
-        try:
-            data = request.json
-            text = data.get('text', '')
-            instruction = data.get('instruction', 'Rewrite the following text:')
-            model = data.get('model', DEFAULT_OLLAMA_MODEL)
+    try:
+        data = get_generation_data()
+        save_to, write_mode = get_write_through(data)
+    except Exception as e:
+        return sse_response([{'error': str(e)}])
+    text = data.get('text', '')
+    instruction = data.get('instruction', 'Rewrite the following text:')
+    model = data.get('model', DEFAULT_OLLAMA_MODEL)
 
-            # Format the prompt
-            prompt = f"{instruction}\n\n{text}"
+    cache_key, cached = lookup_generation('ollama', model, instruction, text, data)
+    if cached:
+        events = replay_cached(cached)
+        return sse_response(write_through(events, save_to, write_mode) if save_to else events)
 
-            # Call Ollama API with streaming
-            response = requests.post(
-                f"{OLLAMA_BASE_URL}/generate",
-                json={
-                    "model": model,
-                    "prompt": prompt,
-                    "stream": True
-                },
-                stream=True,
-                timeout=120
-            )
+    # Reserve a slot before any bytes are sent, so overload can still be answered with 429/503
+    slot = admission['ollama'].acquire()
 
-            if response.status_code == 200:
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            chunk = json.loads(line)
-                            if 'response' in chunk:
-                                yield f"data: {json.dumps({'token': chunk['response']})}\n\n"
-                            if chunk.get('done', False):
-                                yield f"data: {json.dumps({'done': True})}\n\n"
-                        except json.JSONDecodeError:
-                            continue
+    def generate():
+        try:
+            if data.get('incremental'):
+                source = incremental_events('ollama', model, instruction, text)
             else:
-                error_msg = f"Ollama API error: {response.status_code}"
-                yield f"data: {json.dumps({'error': error_msg})}\n\n"
+                pieces = plan_generation('ollama', model, instruction, text,
+                                         data.get('max_tokens'), data.get('auto_chunk', False))
 
+                def stream_fn(piece, plan):
+                    return ollama_stream_events(model, build_prompt(instruction, piece), ollama_options(plan))
+
+                source = stream_pieces(pieces, stream_fn)
+
+            events = cache_stream(cache_key, source)
+            if save_to:
+                events = write_through(events, save_to, write_mode)
+            try:
+                for event in events:
+                    yield sse(event)
+            finally:
+                # On disconnect this lets write-through finish the file before the slot is released
+                events.close()
+
+        except PreflightError as e:
+            yield sse({'error': str(e), 'preflight': preflight_summary(e.plan)})
         except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            yield sse({'error': str(e)})
 
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+    return slot.attach(Response(stream_with_context(generate()), mimetype='text/event-stream'))
 
 @app.route('/list_ollama_models')
 def list_ollama_models():
     """List available Ollama models with caching"""
     try:
         # Check cache
-        current_time = time.time()
-        if current_time - model_cache['ollama']['timestamp'] < CACHE_TTL:
+        cached_models = shared_cache.get('models', 'ollama')
+        if cached_models is not None:
             return jsonify({
                 "success": True,
-                "models": model_cache['ollama']['models'],
+                "models": cached_models,
                 "cached": True
             })
 
         # Fetch from API
-        response = requests.get(f"{OLLAMA_BASE_URL}/tags", timeout=5)
+        with timed('upstream'):
+            response = requests.get(f"{OLLAMA_BASE_URL}/tags", timeout=5)
         if response.status_code == 200:
             models = [model['name'] for model in response.json()['models']]
             # Update cache
-            model_cache['ollama']['models'] = models
-            model_cache['ollama']['timestamp'] = current_time
+            shared_cache.set('models', 'ollama', models, CACHE_TTL)
 
             return jsonify({"success": True, "models": models, "cached": False})
         else:
@@ -267,55 +1528,264 @@ def list_ollama_models():
             "message": str(e)
         })
 
+# ============================================================================
+# OLLAMA WARM-UP
+# ============================================================================
+
+class OllamaWarmup:
+    """Keeps frequently used Ollama models loaded so requests skip the cold start.
+
+    A background thread preloads OLLAMA_PRELOAD_MODELS at startup and again
+    whenever the installed models (/api/tags) change, and tracks which models
+    are resident (/api/ps). keep_alive for each request is scaled from how
+    often that model has been used in the last hour.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.uses = {}          # model -> deque of request timestamps (last hour)
+        self.resident = {}      # model -> expires_at reported by /api/ps
+        self.tags = None
+        self.warming = set()
+        self.load_stats = {}    # model -> cold start counters
+        self.thread = None
+
+    def touch(self, model):
+        now = time.time()
+        with self.lock:
+            uses = self.uses.setdefault(model, deque())
+            uses.append(now)
+            while uses and uses[0] < now - 3600:
+                uses.popleft()
+
+    def keep_alive(self, model):
+        """Seconds to keep model loaded: about twice the average gap between its recent uses"""
+        with self.lock:
+            uses = list(self.uses.get(model, ()))
+        if len(uses) < 2:
+            return OLLAMA_KEEP_ALIVE_MIN
+        average_gap = (uses[-1] - uses[0]) / (len(uses) - 1)
+        return int(min(max(average_gap * 2, OLLAMA_KEEP_ALIVE_MIN), OLLAMA_KEEP_ALIVE_MAX))
+
+    def record_load(self, model, result):
+        """Record Ollama's reported load time for a completed request"""
+        load_s = result.get('load_duration', 0) / 1e9
+        with self.lock:
+            stats = self.load_stats.setdefault(model, {
+                "requests": 0, "cold_starts": 0, "cold_start_total_s": 0.0, "cold_start_max_s": 0.0
+            })
+            stats["requests"] += 1
+            if load_s >= COLD_START_THRESHOLD:
+                stats["cold_starts"] += 1
+                stats["cold_start_total_s"] += load_s
+                stats["cold_start_max_s"] = max(stats["cold_start_max_s"], load_s)
+                stats["last_cold_start_s"] = round(load_s, 3)
+
+    def is_resident(self, model):
+        return model in self.resident
+
+    def preload(self, model):
+        """Load a model into memory without generating anything"""
+        try:
+            started = time.perf_counter()
+            response = requests.post(
+                f"{OLLAMA_BASE_URL}/generate",
+                json={
+                    "model": model,
+                    "keep_alive": self.keep_alive(model),
+                    # Load with the num_ctx a typical request asks for; a different value would reload it
+                    "options": {"num_ctx": preflight('ollama', model, '', '')['num_ctx']}
+                },
+                timeout=120
+            )
+            if response.status_code == 200:
+                self.resident[model] = None
+                app.logger.info("Preloaded Ollama model %s in %.1fs", model, time.perf_counter() - started)
+        except requests.exceptions.RequestException as e:
+            app.logger.warning("Could not preload Ollama model %s: %s", model, e)
+        finally:
+            with self.lock:
+                self.warming.discard(model)
+
+    def warm(self, model):
+        """Preload a model in the background unless it is resident or already warming"""
+        with self.lock:
+            if model in self.resident or model in self.warming:
+                return False
+            self.warming.add(model)
+        threading.Thread(target=self.preload, args=(model,), daemon=True).start()
+        return True
+
+    def poll(self):
+        """Refresh installed and resident models, preloading when the installed set changes"""
+        try:
+            response = requests.get(f"{OLLAMA_BASE_URL}/tags", timeout=5)
+            if response.status_code == 200:
+                tags = {model['name'] for model in response.json().get('models', [])}
+                if tags != self.tags:
+                    self.tags = tags
+                    for model in OLLAMA_PRELOAD_MODELS:
+                        if model in tags:
+                            self.warm(model)
+
+            response = requests.get(f"{OLLAMA_BASE_URL}/ps", timeout=5)
+            if response.status_code == 200:
+                self.resident = {m['name']: m.get('expires_at') for m in response.json().get('models', [])}
+        except requests.exceptions.RequestException:
+            pass
+
+    def run(self):
+        while True:
+            self.poll()
+            time.sleep(OLLAMA_WARMUP_INTERVAL)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='ollama-warmup', daemon=True)
+            self.thread.start()
+
+    def stats(self):
+        with self.lock:
+            models = {}
+            for model, stats in self.load_stats.items():
+                cold = stats["cold_starts"]
+                models[model] = {
+                    "requests": stats["requests"],
+                    "cold_starts": cold,
+                    "cold_start_avg_s": round(stats["cold_start_total_s"] / cold, 3) if cold else 0,
+                    "cold_start_max_s": round(stats["cold_start_max_s"], 3),
+                    "last_cold_start_s": stats.get("last_cold_start_s"),
+                    "uses_last_hour": len(self.uses.get(model, ()))
+                }
+            for model in self.uses:
+                models.setdefault(model, {"requests": 0, "cold_starts": 0,
+                                          "uses_last_hour": len(self.uses[model])})
+            warming = sorted(self.warming)
+        for model in models:
+            models[model]["keep_alive_s"] = self.keep_alive(model)
+            models[model]["resident"] = self.is_resident(model)
+        return {
+            "preload": OLLAMA_PRELOAD_MODELS,
+            "resident": sorted(self.resident),
+            "warming": warming,
+            "models": models
+        }
+
+ollama_warmup = OllamaWarmup()
+
+@app.route('/ollama/warm', methods=['POST'])
+def ollama_warm():
+    """Preload the model the user just selected, so their first request is not a cold start"""
+    model = (request.json or {}).get('model', DEFAULT_OLLAMA_MODEL)
+    if not OLLAMA_WARM_ON_SELECT:
+        return jsonify({"success": True, "model": model, "scheduled": False})
+    scheduled = ollama_warmup.warm(model)
+    return jsonify({
+        "success": True,
+        "model": model,
+        "scheduled": scheduled,
+        "resident": ollama_warmup.is_resident(model)
+    })
+
 # ============================================================================
 # ANTHROPIC ENDPOINTS
 # ============================================================================
 
+def anthropic_complete(model, prompt, max_tokens, temperature=1.0):
+    """Call Claude and return (text, usage) once the whole response is in.
+
+    Large output budgets go through messages.stream(), since the SDK rejects
+    non-streaming requests that may take longer than 10 minutes.
+    """
+    params = {
+        "model": model,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "messages": [
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+    }
+    with timed('upstream'):
+        if max_tokens > ANTHROPIC_NON_STREAMING_MAX_TOKENS:
+            with get_anthropic_client().messages.stream(**params) as stream:
+                message = stream.get_final_message()
+        else:
+            message = get_anthropic_client().messages.create(**params)
+
+    # Extract the response text
+    response_text = ""
+    for block in message.content:
+        if block.type == "text":
+            response_text += block.text
+
+    return response_text, {
+        "input_tokens": message.usage.input_tokens,
+        "output_tokens": message.usage.output_tokens
+    }
+
+def anthropic_stream_events(model, prompt, max_tokens, temperature=1.0):
+    """Call Claude with streaming, yielding {'token': ...} and a final {'done': True, 'usage': ...}"""
+    with get_anthropic_client().messages.stream(
+        model=model,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        messages=[
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+    ) as stream:
+        for text_delta in stream.text_stream:
+            yield {'token': text_delta}
+
+        # Send completion signal with usage stats
+        final_message = stream.get_final_message()
+        yield {'done': True, 'usage': {
+            'input_tokens': final_message.usage.input_tokens,
+            'output_tokens': final_message.usage.output_tokens
+        }}
+
 @app.route('/anthropic', methods=['POST'])
 def anthropic_generate():
     """Generate text using Anthropic Claude (non-streaming)"""
-    if not anthropic_client:
+    if not get_anthropic_client():
         return jsonify({
             "success": False,
             "message": "Anthropic API key not configured. Please set ANTHROPIC_API_KEY in .env file."
         })
 
     try:
-        data = request.json
+        data = get_generation_data()
         text = data.get('text', '')
         instruction = data.get('instruction', 'Rewrite the following text:')
         model = data.get('model', DEFAULT_ANTHROPIC_MODEL)
-        max_tokens = data.get('max_tokens', 4096)
         temperature = data.get('temperature', 1.0)
 
-        # Create the message
-        message = anthropic_client.messages.create(
-            model=model,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"{instruction}\n\n{text}"
-                }
-            ]
-        )
+        save_to, write_mode = get_write_through(data)
+
+        cache_key, cached = lookup_generation('anthropic', model, instruction, text, data,
+                                              temperature=temperature)
+        if cached:
+            if save_to:
+                save_generated(save_to, write_mode, cached["response"])
+                return jsonify({"success": True, **cached, "cached": True, "saved_to": save_to})
+            return jsonify({"success": True, **cached, "cached": True})
 
-        # Extract the response text
-        response_text = ""
-        for block in message.content:
-            if block.type == "text":
-                response_text += block.text
+        with admission['anthropic'].acquire():
+            result = compute_generation('anthropic', model, instruction, text, data, temperature=temperature)
+        return finish_generation(result, cache_key, save_to, write_mode)
 
+    except Overloaded:
+        raise
+    except PreflightError as e:
         return jsonify({
-            "success": True,
-            "response": response_text,
-            "usage": {
-                "input_tokens": message.usage.input_tokens,
-                "output_tokens": message.usage.output_tokens
-            }
+            "success": False,
+            "message": str(e),
+            "preflight": preflight_summary(e.plan)
         })
-
     except anthropic.AuthenticationError:
         return jsonify({
             "success": False,
@@ -340,63 +1810,78 @@ def anthropic_generate():
 @app.route('/anthropic/stream', methods=['POST'])
 def anthropic_stream():
     """Generate text using Anthropic Claude with streaming"""
-    if not anthropic_client:
-        def error_gen():
-            yield f"data: {json.dumps({'error': 'Anthropic API key not configured'})}\n\n"
-        return Response(stream_with_context(error_gen()), mimetype='text/event-stream')
+    if not get_anthropic_client():
+        return sse_response([{'error': 'Anthropic API key not configured'}])
+
+    try:
+        data = get_generation_data()
+        save_to, write_mode = get_write_through(data)
+    except Exception as e:
+        return sse_response([{'error': str(e)}])
+    text = data.get('text', '')
+    instruction = data.get('instruction', 'Rewrite the following text:')
+    model = data.get('model', DEFAULT_ANTHROPIC_MODEL)
+    temperature = data.get('temperature', 1.0)
+
+    cache_key, cached = lookup_generation('anthropic', model, instruction, text, data,
+                                          temperature=temperature)
+    if cached:
+        events = replay_cached(cached)
+        return sse_response(write_through(events, save_to, write_mode) if save_to else events)
+
+    # Reserve a slot before any bytes are sent, so overload can still be answered with 429/503
+    slot = admission['anthropic'].acquire()
 
     def generate():
         try:
-            data = request.json
-            text = data.get('text', '')
-            instruction = data.get('instruction', 'Rewrite the following text:')
-            model = data.get('model', DEFAULT_ANTHROPIC_MODEL)
-            max_tokens = data.get('max_tokens', 4096)
-            temperature = data.get('temperature', 1.0)
-
-            # Stream the response
-            with anthropic_client.messages.stream(
-                model=model,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": f"{instruction}\n\n{text}"
-                    }
-                ]
-            ) as stream:
-                for text_delta in stream.text_stream:
-                    yield f"data: {json.dumps({'token': text_delta})}\n\n"
-
-                # Send completion signal with usage stats
-                final_message = stream.get_final_message()
-                yield f"data: {json.dumps({'done': True, 'usage': {'input_tokens': final_message.usage.input_tokens, 'output_tokens': final_message.usage.output_tokens}})}\n\n"
+            if data.get('incremental'):
+                source = incremental_events('anthropic', model, instruction, text, temperature)
+            else:
+                pieces = plan_generation('anthropic', model, instruction, text,
+                                         data.get('max_tokens'), data.get('auto_chunk', False))
+
+                def stream_fn(piece, plan):
+                    return anthropic_stream_events(model, build_prompt(instruction, piece),
+                                                   plan['max_tokens'], temperature)
 
+                source = stream_pieces(pieces, stream_fn)
+
+            events = cache_stream(cache_key, source)
+            if save_to:
+                events = write_through(events, save_to, write_mode)
+            try:
+                for event in events:
+                    yield sse(event)
+            finally:
+                # On disconnect this lets write-through finish the file before the slot is released
+                events.close()
+
+        except PreflightError as e:
+            yield sse({'error': str(e), 'preflight': preflight_summary(e.plan)})
         except anthropic.AuthenticationError:
-            yield f"data: {json.dumps({'error': 'Invalid Anthropic API key'})}\n\n"
+            yield sse({'error': 'Invalid Anthropic API key'})
         except anthropic.RateLimitError:
-            yield f"data: {json.dumps({'error': 'Rate limit exceeded'})}\n\n"
+            yield sse({'error': 'Rate limit exceeded'})
         except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            yield sse({'error': str(e)})
 
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+    return slot.attach(Response(stream_with_context(generate()), mimetype='text/event-stream'))
 
 @app.route('/list_anthropic_models')
 def list_anthropic_models():
     """List available Anthropic models"""
-    if not anthropic_client:
+    if not get_anthropic_client():
         return jsonify({
             "success": False,
             "message": "Anthropic API key not configured"
         })
 
     # Check cache
-    current_time = time.time()
-    if current_time - model_cache['anthropic']['timestamp'] < CACHE_TTL:
+    cached_models = shared_cache.get('models', 'anthropic')
+    if cached_models is not None:
         return jsonify({
             "success": True,
-            "models": model_cache['anthropic']['models'],
+            "models": cached_models,
             "cached": True
         })
 
@@ -409,8 +1894,7 @@ def list_anthropic_models():
     ]
 
     # Update cache
-    model_cache['anthropic']['models'] = models
-    model_cache['anthropic']['timestamp'] = current_time
+    shared_cache.set('models', 'anthropic', models, CACHE_TTL)
 
     return jsonify({
         "success": True,
@@ -432,7 +1916,7 @@ def list_models():
     errors = {}
 
     # Get Anthropic models
-    if anthropic_client:
+    if ANTHROPIC_API_KEY:
         anthropic_response = list_anthropic_models()
         anthropic_data = anthropic_response.get_json()
         if anthropic_data.get('success'):
@@ -474,491 +1958,1099 @@ def generate():
         else:
             return ollama_generate()
 
-# ============================================================================
-# HEALTH CHECK
-# ============================================================================
-
-@app.route('/health')
-def health():
-    """Health check endpoint to verify service status"""
-    status = {
-        "anthropic": {
-            "configured": anthropic_client is not None,
-            "available": False
-        },
-        "ollama": {
-            "available": False
-        }
-    }
-
-    # Check Anthropic
-    if anthropic_client:
-        try:
-            # Quick validation - just check if client is initialized
-            status["anthropic"]["available"] = True
-        except:
-            pass
-
-    # Check Ollama
-    try:
-        response = requests.get(f"{OLLAMA_BASE_URL}/tags", timeout=2)
-        status["ollama"]["available"] = response.status_code == 200
-    except:
-        pass
-
-    return jsonify(status)
-
-if __name__ == '__main__':
-    # Create the templates directory if it doesn't exist
-    os.makedirs('templates', exist_ok=True)
-
-    # Create the static directory if it doesn't exist
-    os.makedirs('static', exist_ok=True)
-
-    # Create the index.html file
-    with open('templates/index.html', 'w', encoding='utf-8') as f:
-        f.write('''<!DOCTYPE html>
-<html>
-<head>
-    <title>Enhanced Text Editor</title>
-    <link rel="stylesheet" href="/static/styles.css">
-</head>
-<body>
-    <div class="header">
-        <div class="file-controls">
-            <input type="text" id="filename" placeholder="filename.md">
-            <button id="save-btn">Save</button>
-            <button id="load-btn">Load</button>
-            <select id="file-list">
-                <option value="">Select a file</option>
-            </select>
-            <div class="option-controls">
-                <label>
-                    <input type="checkbox" id="sync-scroll"> Sync Scrolling
-                </label>
-                <label>
-                    <input type="checkbox" id="markdown-preview"> Markdown Preview
-                </label>
-            </div>
-        </div>
-    </div>
-
-    <div class="container">
-        <div class="column">
-            <div class="column-header">
-                <h2>New Text</h2>
-                <div class="column-stats">
-                    <span id="newWordCount">0 words</span>
-                    <span id="newLastUpdated"></span>
-                </div>
-            </div>
-            <div class="editor-container">
-                <textarea id="newText" placeholder="Enter new text here..."></textarea>
-                <div class="markdown-preview" id="newPreview"></div>
-            </div>
-            <div class="resize-handle"></div>
-        </div>
-        <div class="column">
-            <div class="column-header">
-                <h2>Original Text</h2>
-                <div class="column-stats">
-                    <span id="originalWordCount">0 words</span>
-                    <span id="originalLastUpdated"></span>
-                </div>
-            </div>
-            <div class="editor-container">
-                <textarea id="originalText" placeholder="Enter original text here..."></textarea>
-                <div class="markdown-preview" id="originalPreview"></div>
-            </div>
-        </div>
-    </div>
-
-    <div class="terminal-container">
-        <div class="terminal-header">
-            <span>AI Assistant Terminal</span>
-            <div class="terminal-controls">
-                <select id="provider-select">
-                    <option value="anthropic">Anthropic Claude</option>
-                    <option value="ollama">Ollama (Local)</option>
-                </select>
-                <select id="model-list">
-                    <option value="">Loading models...</option>
-                </select>
-                <label class="stream-toggle">
-                    <input type="checkbox" id="stream-toggle" checked> Stream
-                </label>
-                <button id="terminal-clear">Clear</button>
-                <button id="terminal-toggle">▲</button>
-            </div>
-        </div>
-        <div class="terminal-content" id="terminal-content">
-            <div class="terminal-output" id="terminal-output">
-                <p>Welcome to the AI Assistant Terminal.</p>
-                <p>Type /help for available commands.</p>
-            </div>
-            <div class="terminal-input-container">
-                <span class="prompt">></span>
-                <input type="text" id="terminal-input" placeholder="Type a command or question...">
-            </div>
-        </div>
-        <div class="terminal-resize-handle"></div>
-    </div>
-
-    <div id="status-message"></div>
-
-    <script src="/static/script.js"></script>
-</body>
-</html>''')
-
-    # Create the CSS file
-    with open('static/styles.css', 'w', encoding='utf-8') as f:
-        f.write('''body {
-    font-family: Arial, sans-serif;
-    margin: 0;
-    padding: 0;
-    height: 100vh;
-    display: flex;
-    flex-direction: column;
-}
-
-.header {
-    background-color: #f1f1f1;
-    padding: 10px;
-    border-bottom: 1px solid #ddd;
-}
-
-.file-controls {
-    display: flex;
-    gap: 10px;
-    align-items: center;
-    flex-wrap: wrap;
-}
-
-.option-controls {
-    margin-left: auto;
-    display: flex;
-    gap: 15px;
-}
-
-.container {
-    display: flex;
-    flex: 1;
-    height: calc(100vh - 180px);
-    min-height: 0;
-    overflow: hidden;
-    position: relative;
-}
-
-.column {
-    flex: 1;
-    padding: 30px;
-    box-sizing: border-box;
-    display: flex;
-    flex-direction: column;
-    position: relative;
-    min-width: 200px;
-}
-
-.resize-handle {
-    position: absolute;
-    top: 0;
-    bottom: 0;
-    width: 5px;
-    background: #ddd;
-    cursor: col-resize;
-    z-index: 10;
-}
-
-.resize-handle:hover {
-    background: #999;
-}
-
-.column:first-child {
-    border-right: 1px solid #ddd;
-    background-color: #f9f9f9;
-}
-
-.column:first-child .resize-handle {
-    right: 0;
-}
-
-.column-header {
-    display: flex;
-    justify-content: space-between;
-    align-items: center;
-    margin-bottom: 10px;
-}
-
-.column-stats {
-    font-size: 0.9em;
-    color: #666;
-    display: flex;
-    gap: 15px;
-}
-
-.column-stats span {
-    white-space: nowrap;
-}
+def generation_events(provider, model, instruction, text, max_tokens=None,
+                      temperature=1.0, auto_chunk=False):
+    """Stream events for a generation on either provider, outside of any request context"""
+    pieces = plan_generation(provider, model, instruction, text, max_tokens, auto_chunk)
 
-h2 {
-    margin: 0;
-    font-size: 1.2em;
-    color: #333;
-}
-
-.editor-container {
-    position: relative;
-    flex: 1;
-    display: flex;
-    flex-direction: column;
-    min-height: 0;
-    overflow: hidden;
-    padding: 5px;
-    background: #fff;
-    border-radius: 4px;
-    box-shadow: 0 1px 3px rgba(0,0,0,0.1);
-}
-
-.markdown-preview {
-    display: none;
-    padding: 15px;
-    background: white;
-    border: 1px solid #ddd;
-    overflow-y: auto;
-    flex: 1;
-    height: 100%;
-    box-sizing: border-box;
-    min-height: 0;
-    border-radius: 3px;
-}
-
-.markdown-preview.active {
-    display: block;
-}
-
-textarea {
-    width: 100%;
-    height: 100%;
-    border: 1px solid #ddd;
-    resize: none;
-    flex: 1;
-    padding: 15px;
-    font-family: 'Courier New', Courier, monospace;
-    font-size: 14px;
-    line-height: 1.5;
-    box-sizing: border-box;
-    min-height: 0;
-    border-radius: 3px;
-}
-
-button {
-    padding: 5px 10px;
-    background-color: #4CAF50;
-    color: white;
-    border: none;
-    cursor: pointer;
-    border-radius: 3px;
-}
+    if provider == 'anthropic':
+        if not get_anthropic_client():
+            raise RuntimeError("Anthropic API key not configured")
 
-button:hover {
-    background-color: #45a049;
-}
+        def stream_fn(piece, plan):
+            return anthropic_stream_events(model, build_prompt(instruction, piece),
+                                           plan['max_tokens'], temperature)
+    else:
+        def stream_fn(piece, plan):
+            return ollama_stream_events(model, build_prompt(instruction, piece), ollama_options(plan))
 
-button:disabled {
-    background-color: #ccc;
-    cursor: not-allowed;
-}
+    return stream_pieces(pieces, stream_fn)
 
-input, select {
-    padding: 5px;
-    border: 1px solid #ddd;
-    border-radius: 3px;
-}
+def complete_piece(provider, model, instruction, text, plan, temperature=1.0):
+    """Run one planned non-streaming generation on either provider and return (text, usage)"""
+    prompt = build_prompt(instruction, text)
+    if provider == 'anthropic':
+        if not get_anthropic_client():
+            raise RuntimeError("Anthropic API key not configured")
+        return anthropic_complete(model, prompt, plan['max_tokens'], temperature)
+    return ollama_complete(model, prompt, ollama_options(plan))
+
+def provider_complete(provider, model, instruction, text, max_tokens=None, temperature=1.0):
+    """Run a single non-streaming generation on either provider and return (text, usage)"""
+    plan = preflight(provider, model, instruction, text, max_tokens)
+    if not plan['fits']:
+        raise PreflightError(f"Prompt is too large for {model}", plan)
+    return complete_piece(provider, model, instruction, text, plan, temperature)
+
+def compute_generation(provider, model, instruction, text, data, temperature=1.0):
+    """Produce the result of a non-streaming generation request (without caching it).
+
+    Honours the request's incremental, auto_chunk and max_tokens options, so
+    the result matches what the generation cache key describes.
+    """
+    if data.get('incremental'):
+        return collect_events(incremental_events(provider, model, instruction, text, temperature))
+
+    pieces = plan_generation(provider, model, instruction, text,
+                             data.get('max_tokens'), data.get('auto_chunk', False))
+    responses = []
+    usage = {}
+    for piece, plan in pieces:
+        response_text, piece_usage = complete_piece(provider, model, instruction, piece, plan, temperature)
+        responses.append(response_text)
+        merge_usage(usage, piece_usage)
+
+    return {
+        "response": "\n\n".join(responses),
+        "usage": usage,
+        "chunks": len(pieces)
+    }
 
-#status-message {
-    padding: 10px;
-    text-align: center;
-    color: #666;
-}
+# ============================================================================
+# INCREMENTAL REWRITE
+# ============================================================================
 
-/* Terminal Styles */
-.terminal-container {
-    background-color: #1e1e1e;
-    color: #f0f0f0;
-    border-top: 1px solid #333;
-    height: 180px;
-    display: flex;
-    flex-direction: column;
-    transition: height 0.3s ease;
-    position: relative;
-    min-height: 100px;
-}
+INCREMENTAL_INSTRUCTION = (
+    "Apply it only to the paragraph marked PARAGRAPH below. The CONTEXT "
+    "paragraphs are for reference and must not be repeated. Reply with the "
+    "rewritten paragraph only."
+)
+INCREMENTAL_GROUP_INSTRUCTION = (
+    "Apply it separately to each paragraph marked [[PARAGRAPH n]] below. The "
+    "CONTEXT paragraphs are for reference and must not be repeated. Reply with "
+    "every rewritten paragraph in the same order, each on its own after its "
+    "[[PARAGRAPH n]] marker line, and nothing else."
+)
+GROUP_MARKER_PATTERN = re.compile(r'^\s*\[\[PARAGRAPH (\d+)\]\]\s*$', re.MULTILINE)
+
+def paragraph_cache_key(provider, model, instruction, paragraph, temperature=1.0):
+    payload = json.dumps([provider, model, instruction, temperature, paragraph_hash(paragraph)])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def incremental_prompt(paragraphs, index):
+    """Text for rewriting paragraphs[index], with a trimmed neighbour on each side as context"""
+    parts = []
+    if index > 0:
+        parts.append(f"CONTEXT BEFORE:\n{paragraphs[index - 1][-INCREMENTAL_CONTEXT_CHARS:]}")
+    parts.append(f"PARAGRAPH:\n{paragraphs[index]}")
+    if index + 1 < len(paragraphs):
+        parts.append(f"CONTEXT AFTER:\n{paragraphs[index + 1][:INCREMENTAL_CONTEXT_CHARS]}")
+    return "\n\n".join(parts)
+
+def incremental_group_prompt(paragraphs, group):
+    """Text for rewriting several paragraphs in one request.
+
+    Neighbours that are not themselves being rewritten are included, trimmed,
+    as context, each only once.
+    """
+    parts = []
+    included = set(group)
+    for n, index in enumerate(group, 1):
+        if index > 0 and index - 1 not in included:
+            parts.append(f"CONTEXT:\n{paragraphs[index - 1][-INCREMENTAL_CONTEXT_CHARS:]}")
+            included.add(index - 1)
+        parts.append(f"[[PARAGRAPH {n}]]\n{paragraphs[index]}")
+        if index + 1 < len(paragraphs) and index + 1 not in included:
+            parts.append(f"CONTEXT:\n{paragraphs[index + 1][:INCREMENTAL_CONTEXT_CHARS]}")
+            included.add(index + 1)
+    return "\n\n".join(parts)
+
+def split_group_response(response, count):
+    """Split a grouped reply into its paragraphs, or None if the markers do not line up"""
+    pieces = GROUP_MARKER_PATTERN.split(response)
+    outputs = {}
+    for marker, text in zip(pieces[1::2], pieces[2::2]):
+        outputs[int(marker)] = text.strip()
+    if sorted(outputs) != list(range(1, count + 1)):
+        return None
+    return [outputs[n] for n in range(1, count + 1)]
+
+def rewrite_group(provider, model, instruction, paragraphs, group, temperature=1.0):
+    """Rewrite the paragraphs at the given indexes and return ([outputs], usage).
+
+    The whole group goes out as one request; if the reply cannot be split
+    back into paragraphs, each one is sent on its own instead.
+    """
+    usage = {}
+    if len(group) > 1:
+        output, group_usage = provider_complete(
+            provider, model, f"{instruction}\n\n{INCREMENTAL_GROUP_INSTRUCTION}",
+            incremental_group_prompt(paragraphs, group), temperature=temperature)
+        merge_usage(usage, group_usage)
+        outputs = split_group_response(output, len(group))
+        if outputs is not None:
+            return outputs, usage
+
+    outputs = []
+    for index in group:
+        output, paragraph_usage = provider_complete(
+            provider, model, f"{instruction}\n\n{INCREMENTAL_INSTRUCTION}",
+            incremental_prompt(paragraphs, index), temperature=temperature)
+        merge_usage(usage, paragraph_usage)
+        outputs.append(output.strip())
+    return outputs, usage
+
+def incremental_events(provider, model, instruction, text, temperature=1.0):
+    """Rewrite text paragraph by paragraph, reusing cached rewrites of unchanged paragraphs.
+
+    Outputs are cached per (provider, model, instruction, temperature,
+    paragraph hash), so re-running after a small edit only sends the edited
+    paragraphs. Uncached paragraphs are rewritten in groups of up to
+    INCREMENTAL_GROUP_TOKENS, one request per group. Yields one token event
+    per paragraph, in document order.
+    """
+    paragraphs = split_paragraphs(text)
+    keys = [paragraph_cache_key(provider, model, instruction, p, temperature) for p in paragraphs]
+    outputs = {}
+    for index, key in enumerate(keys):
+        cached = shared_cache.get('paragraph', key)
+        if cached is not None:
+            outputs[index] = cached
+    reused = len(outputs)
+    usage = {}
+
+    for index, paragraph in enumerate(paragraphs):
+        if index:
+            yield {'token': '\n\n'}
+
+        if index not in outputs:
+            # Group this paragraph with the next uncached ones, up to the token budget
+            group = [index]
+            group_tokens = count_tokens(paragraph)
+            for later in range(index + 1, len(paragraphs)):
+                if later in outputs:
+                    continue
+                later_tokens = count_tokens(paragraphs[later])
+                if group_tokens + later_tokens > INCREMENTAL_GROUP_TOKENS:
+                    break
+                group.append(later)
+                group_tokens += later_tokens
+
+            group_outputs, group_usage = rewrite_group(provider, model, instruction, paragraphs,
+                                                       group, temperature)
+            merge_usage(usage, group_usage)
+            for group_index, output in zip(group, group_outputs):
+                outputs[group_index] = output
+                shared_cache.set('paragraph', keys[group_index], output, PARAGRAPH_CACHE_TTL)
+        yield {'token': outputs[index]}
+
+    yield {
+        'done': True,
+        'usage': usage,
+        'paragraphs': len(paragraphs),
+        'reused': reused,
+        'rewritten': len(paragraphs) - reused
+    }
 
-.terminal-resize-handle {
-    position: absolute;
-    left: 0;
-    right: 0;
-    top: -5px;
-    height: 5px;
-    background: #333;
-    cursor: row-resize;
-    z-index: 10;
-}
+# ============================================================================
+# MODEL COMPARISON
+# ============================================================================
 
-.terminal-resize-handle:hover {
-    background: #666;
-}
+def run_compare_target(index, target, instruction, text, options, events, cancelled):
+    """Run one comparison target, pushing tagged events onto the shared queue.
 
-.terminal-container.minimized {
-    height: 30px;
-}
+    Always ends by putting the target's report, even on unexpected errors,
+    since the stream waits for one report per target.
+    """
+    report = {"target": index}
+    try:
+        measure_compare_target(index, target, instruction, text, options, events, cancelled, report)
+    except Exception as e:
+        report.setdefault("error", str(e))
+    events.put({"target": index, "report": report})
+
+def measure_compare_target(index, target, instruction, text, options, events, cancelled, report):
+    """Generate for one target, filling report with its timings and usage"""
+    provider = target.get('provider', 'ollama')
+    model = target.get('model') or (DEFAULT_ANTHROPIC_MODEL if provider == 'anthropic' else DEFAULT_OLLAMA_MODEL)
+    report.update(provider=provider, model=model)
+    first_token = None
+    token_events = 0
+
+    queued = time.perf_counter()
+    try:
+        slot = admission.get(provider, admission['ollama']).acquire()
+    except Overloaded as e:
+        report.update(queue_wait_s=round(time.perf_counter() - queued, 3),
+                      error=str(e), retry_after=e.retry_after)
+        return
+    # Latency figures cover the generation itself; time spent waiting for a slot is reported separately
+    started = time.perf_counter()
+    report["queue_wait_s"] = round(started - queued, 3)
 
-.terminal-container.minimized .terminal-resize-handle {
-    display: none;
-}
+    try:
+        for event in generation_events(provider, model, instruction, text, **options):
+            if cancelled.is_set():
+                report["error"] = "cancelled"
+                break
+            if event.get('done'):
+                report["usage"] = event.get('usage', {})
+                continue
+            if first_token is None:
+                first_token = time.perf_counter()
+            token_events += 1
+            events.put({"target": index, "token": event['token']})
+    except PreflightError as e:
+        report["error"] = str(e)
+    except Exception as e:
+        report["error"] = str(e)
+    finally:
+        slot.release()
+
+    finished = time.perf_counter()
+    report["latency_s"] = round(finished - started, 3)
+    if first_token is not None:
+        report["ttft_s"] = round(first_token - started, 3)
+        output_tokens = report.get("usage", {}).get("output_tokens") or token_events
+        report["tokens_per_sec"] = round(output_tokens / max(finished - first_token, 1e-6), 1)
+
+@app.route('/compare', methods=['POST'])
+def compare():
+    """Run one prompt against several (provider, model) targets concurrently.
+
+    Streams tagged token events ({"target": i, "token": ...}) as they arrive
+    and finishes with a per-target report of latency, time to first token,
+    tokens/sec and token usage.
+    """
+    try:
+        data = get_generation_data()
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)})
 
-.terminal-header {
-    background-color: #2d2d2d;
-    padding: 5px 10px;
-    display: flex;
-    justify-content: space-between;
-    align-items: center;
-    font-size: 14px;
-}
+    targets = data.get('targets') or []
+    if not isinstance(targets, list) or not targets or len(targets) > COMPARE_MAX_TARGETS:
+        return jsonify({
+            "success": False,
+            "message": f"Provide between 1 and {COMPARE_MAX_TARGETS} targets."
+        })
+    if not all(isinstance(target, dict) for target in targets):
+        return jsonify({
+            "success": False,
+            "message": 'Each target must be an object like {"provider": "ollama", "model": "llama3.1:latest"}.'
+        }), 400
+
+    text = data.get('text', '')
+    instruction = data.get('instruction', 'Rewrite the following text:')
+    options = {
+        "max_tokens": data.get('max_tokens'),
+        "temperature": data.get('temperature', 1.0),
+        "auto_chunk": data.get('auto_chunk', False)
+    }
 
-.terminal-controls {
-    display: flex;
-    gap: 5px;
-    align-items: center;
-}
+    def generate():
+        events = queue.Queue()
+        cancelled = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=len(targets))
+        started = time.perf_counter()
+        try:
+            for index, target in enumerate(targets):
+                executor.submit(run_compare_target, index, target, instruction, text,
+                                options, events, cancelled)
+
+            reports = [None] * len(targets)
+            remaining = len(targets)
+            while remaining:
+                try:
+                    event = events.get(timeout=COMPARE_EVENT_TIMEOUT)
+                except queue.Empty:
+                    # A worker was lost: report the silent targets instead of waiting forever
+                    for index, report in enumerate(reports):
+                        if report is None:
+                            reports[index] = {"target": index, "error": "No response from target"}
+                            yield sse({"target": index, "done": True, **reports[index]})
+                    break
+                if 'report' in event:
+                    reports[event['target']] = event['report']
+                    remaining -= 1
+                    yield sse({"target": event['target'], "done": True, **event['report']})
+                else:
+                    yield sse(event)
+
+            yield sse({
+                "done": True,
+                "wall_time_s": round(time.perf_counter() - started, 3),
+                "report": reports
+            })
+        finally:
+            # Client went away or we finished: stop any targets still streaming
+            cancelled.set()
+            executor.shutdown(wait=False)
 
-.terminal-controls button {
-    background-color: #444;
-    font-size: 12px;
-    padding: 2px 8px;
-}
+    return Response(generate(), mimetype='text/event-stream')
 
-.terminal-controls button:hover {
-    background-color: #555;
-}
+# ============================================================================
+# SEMANTIC ALIGNMENT
+# ============================================================================
 
-.terminal-controls select {
-    background-color: #444;
-    color: #f0f0f0;
-    border: 1px solid #555;
-    font-size: 12px;
-}
+def split_paragraphs(text):
+    """Split text into paragraphs on blank lines, dropping empty ones"""
+    return [p.strip() for p in re.split(r'\n\s*\n', text or '') if p.strip()]
+
+def get_pair_folder(filename):
+    """Return (folder_name, folder_path) for a pair, rejecting path traversal"""
+    folder_name = os.path.splitext(os.path.basename(filename or ''))[0]
+    if not folder_name or folder_name.startswith('.'):
+        raise ValueError(f"Invalid pair name: {filename!r}")
+    return folder_name, os.path.join('data', folder_name)
+
+def read_pair(filename):
+    """Read (original_text, new_text) for a saved pair"""
+    folder_name, folder_path = get_pair_folder(filename)
+    with timed('io'):
+        with open(os.path.join(folder_path, f"{folder_name}_original.md"), 'r', encoding='utf-8') as f:
+            original_text = f.read()
+        new_text = ''
+        new_path = os.path.join(folder_path, f"{folder_name}_new.md")
+        if os.path.exists(new_path):
+            with open(new_path, 'r', encoding='utf-8') as f:
+                new_text = f.read()
+    return original_text, new_text
+
+def paragraph_hash(paragraph):
+    return hashlib.sha256(paragraph.encode('utf-8')).hexdigest()
+
+def embed_paragraphs(paragraphs, model=OLLAMA_EMBED_MODEL):
+    """Embed paragraphs with Ollama, reusing vectors cached on disk by paragraph hash.
+
+    Returns a float32 matrix with one row per paragraph.
+    """
+    cache_dir = os.path.join(EMBEDDING_CACHE_DIR, re.sub(r'[^A-Za-z0-9_.-]', '_', model))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    hashes = [paragraph_hash(p) for p in paragraphs]
+    vectors = {}
+    missing = {}
+    for h, paragraph in zip(hashes, paragraphs):
+        if h in vectors or h in missing:
+            continue
+        cache_path = os.path.join(cache_dir, f"{h}.npy")
+        try:
+            vectors[h] = np.load(cache_path)
+        except (OSError, ValueError):
+            missing[h] = paragraph
+
+    # Ollama accepts a batch of inputs per /embed call; keep each one bounded so
+    # a cold cache on a long document does not run into the timeout, and cache
+    # every sub-batch as it returns so a failure later keeps the earlier work
+    pending = list(missing.items())
+    for offset in range(0, len(pending), EMBED_BATCH_SIZE):
+        batch = pending[offset:offset + EMBED_BATCH_SIZE]
+        with timed('upstream'):
+            response = requests.post(
+                f"{OLLAMA_BASE_URL}/embed",
+                json={"model": model, "input": [paragraph for _, paragraph in batch]},
+                timeout=120
+            )
+        if response.status_code != 200:
+            error_msg = f"Ollama embed error: {response.status_code}"
+            try:
+                error_msg += f" - {response.json().get('error', '')}"
+            except:
+                pass
+            raise RuntimeError(error_msg)
+
+        embeddings = response.json().get('embeddings', [])
+        if len(embeddings) != len(batch):
+            raise RuntimeError("Ollama returned an unexpected number of embeddings")
+
+        for (h, _), embedding in zip(batch, embeddings):
+            vector = np.asarray(embedding, dtype=np.float32)
+            vectors[h] = vector
+            # Write to a temp file first so concurrent readers never see a partial vector
+            cache_path = os.path.join(cache_dir, f"{h}.npy")
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, vector)
+            os.replace(tmp_path, cache_path)
+
+    if not paragraphs:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.stack([vectors[h] for h in hashes])
+
+def align_paragraphs(original_vectors, new_vectors, threshold=ALIGNMENT_THRESHOLD):
+    """Align paragraphs by cosine similarity.
+
+    Each original paragraph is mapped to its most similar new paragraph, so
+    paragraphs merged by a rewrite share a target. Returns the similarity
+    matrix, per-original best match/score and per-new best match/score.
+    """
+    def normalize(m):
+        norms = np.linalg.norm(m, axis=1, keepdims=True)
+        return m / np.maximum(norms, 1e-12)
+
+    similarity = normalize(original_vectors) @ normalize(new_vectors).T
+
+    best_new = similarity.argmax(axis=1)
+    best_new_score = similarity[np.arange(similarity.shape[0]), best_new]
+    best_original = similarity.argmax(axis=0)
+    best_original_score = similarity[best_original, np.arange(similarity.shape[1])]
+
+    return {
+        "similarity": similarity,
+        "best_new": np.where(best_new_score >= threshold, best_new, -1),
+        "best_new_score": best_new_score,
+        "best_original": np.where(best_original_score >= threshold, best_original, -1),
+        "best_original_score": best_original_score
+    }
 
-.stream-toggle {
-    display: flex;
-    align-items: center;
-    gap: 4px;
-    color: #f0f0f0;
-    font-size: 12px;
-}
+@app.route('/align', methods=['POST'])
+def align():
+    """Align paragraphs of the original and rewritten text by meaning"""
+    try:
+        data = request.json or {}
+        if data.get('filename'):
+            original_text, new_text = read_pair(data['filename'])
+        else:
+            original_text = data.get('original_text', '')
+            new_text = data.get('new_text', '')
+        model = data.get('model', OLLAMA_EMBED_MODEL)
+        threshold = float(data.get('threshold', ALIGNMENT_THRESHOLD))
+
+        original_paragraphs = split_paragraphs(original_text)
+        new_paragraphs = split_paragraphs(new_text)
+        if not original_paragraphs or not new_paragraphs:
+            return jsonify({
+                "success": False,
+                "message": "Both texts need at least one paragraph to align."
+            })
 
-.terminal-content {
-    flex: 1;
-    display: flex;
-    flex-direction: column;
-    overflow: hidden;
-}
+        # Embed both sides in one pass so the cache lookup and API call are shared
+        with admission['ollama'].acquire():
+            vectors = embed_paragraphs(original_paragraphs + new_paragraphs, model=model)
+        result = align_paragraphs(vectors[:len(original_paragraphs)],
+                                  vectors[len(original_paragraphs):],
+                                  threshold=threshold)
+
+        alignment = [
+            {"original": i, "new": int(j), "score": round(float(score), 4)}
+            for i, (j, score) in enumerate(zip(result['best_new'].tolist(),
+                                               result['best_new_score'].tolist()))
+        ]
+        added = np.flatnonzero(result['best_original'] < 0).tolist()
+        removed = np.flatnonzero(result['best_new'] < 0).tolist()
+
+        response = {
+            "success": True,
+            "model": model,
+            "original_paragraphs": len(original_paragraphs),
+            "new_paragraphs": len(new_paragraphs),
+            "alignment": alignment,
+            "added": added,
+            "removed": removed
+        }
+        if data.get('include_matrix'):
+            response["similarity"] = np.round(result['similarity'], 4).tolist()
+        return jsonify(response)
+    except Overloaded:
+        raise
+    except FileNotFoundError:
+        return jsonify({"success": False, "message": "File not found"})
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)})
+    except requests.exceptions.Timeout:
+        return jsonify({
+            "success": False,
+            "message": "Request to Ollama timed out while computing embeddings."
+        })
+    except requests.exceptions.ConnectionError:
+        return jsonify({
+            "success": False,
+            "message": "Could not connect to Ollama. Make sure it's running on localhost:11434"
+        })
+    except Exception as e:
+        return jsonify({"success": False, "message": f"Error: {str(e)}"})
 
-.terminal-output {
-    flex: 1;
-    overflow-y: auto;
-    padding: 10px;
-    font-family: 'Courier New', Courier, monospace;
-    font-size: 13px;
-}
+# ============================================================================
+# SPECULATIVE PRE-GENERATION
+# ============================================================================
 
-.terminal-output p {
-    margin: 2px 0;
-    white-space: pre-wrap;
-    word-wrap: break-word;
+# Instructions and options for the terminal commands (must match static/script.js),
+# so a precomputed result lands under the exact cache key of the user's request
+COMMAND_REQUESTS = {
+    "rewrite": ("Rewrite the following text in a clearer, more concise way. Preserve any markdown formatting:",
+                {"auto_chunk": True, "incremental": True}),
+    "improve": ("Improve the following text by enhancing its clarity, structure, and style. Preserve any markdown formatting:",
+                {"auto_chunk": True, "incremental": True}),
+    "summarize": ("Summarize the following text in a few sentences. Use markdown formatting for better readability:",
+                  {"auto_chunk": True, "incremental": False}),
+    "expand": ("Expand on the following text with more details and examples. Use markdown formatting for better structure:",
+               {"auto_chunk": True, "incremental": False})
 }
 
-.terminal-input-container {
-    display: flex;
-    padding: 5px 10px;
-    background-color: #2d2d2d;
-}
+class Speculator:
+    """Precomputes configured commands for a pair right after it is loaded.
+
+    Jobs run one at a time on a background thread, newest first, and only
+    take an admission slot while the provider has nothing else running or
+    queued on the host (checked in the shared admission table), so
+    interactive requests in any worker never wait behind them.
+    Results are stored in the generation cache marked as speculative; the
+    first request that hits one counts towards the hit rate. Counters and
+    the hourly budget live in the shared cache so they cover all workers.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()  # (provider, model, filename, command) -> scheduled_at
+        self.thread = None
+
+    def count(self, name, amount=1):
+        return shared_cache.incr('speculative', name, amount, STATS_TTL)
+
+    def schedule(self, provider, model, filename):
+        """Queue the configured commands for a loaded pair; returns the commands queued"""
+        if (not SPECULATIVE_ENABLED or GENERATION_CACHE_TTL <= 0
+                or provider not in SPECULATIVE_PROVIDERS or not model):
+            return []
+        commands = [c for c in SPECULATIVE_COMMANDS if c in COMMAND_REQUESTS]
+        with self.condition:
+            for command in commands:
+                job = (provider, model, filename, command)
+                self.pending.pop(job, None)
+                self.pending[job] = time.time()
+            while len(self.pending) > SPECULATIVE_MAX_PENDING:
+                self.pending.popitem(last=False)
+            self.condition.notify()
+        if commands:
+            self.count('scheduled', len(commands))
+        return commands
+
+    def next_job(self):
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            return self.pending.popitem(last=True)
+
+    def wait_for_slot(self, provider, scheduled_at):
+        """Wait until the provider is idle; None once the job has waited too long"""
+        while True:
+            slot = admission[provider].acquire_if_idle()
+            if slot or time.time() - scheduled_at > SPECULATIVE_MAX_WAIT:
+                return slot
+            time.sleep(SPECULATIVE_IDLE_POLL)
+
+    def within_budget(self):
+        hour = int(time.time() // 3600)
+        tokens = shared_cache.get('speculative', f'tokens:{hour}') or 0
+        if tokens >= SPECULATIVE_MAX_TOKENS_PER_HOUR:
+            return False
+        return shared_cache.incr('speculative', f'runs:{hour}', 1, 7200) <= SPECULATIVE_MAX_PER_HOUR
+
+    def run_job(self, job, scheduled_at):
+        provider, model, filename, command = job
+        instruction, data = COMMAND_REQUESTS[command]
+        try:
+            text = read_pair(filename)[0].strip()
+        except (FileNotFoundError, ValueError):
+            return
+        if not text or len(text) > SPECULATIVE_MAX_CHARS:
+            self.count('skipped_size')
+            return
+
+        params = {'temperature': 1.0} if provider == 'anthropic' else {}
+        key = request_cache_key(provider, model, instruction, text, data, **params)
+        if shared_cache.get('generation', key) is not None:
+            self.count('skipped_cached')
+            return
+
+        slot = self.wait_for_slot(provider, scheduled_at)
+        if slot is None:
+            self.count('skipped_busy')
+            return
+        with slot:
+            if not self.within_budget():
+                self.count('skipped_budget')
+                return
+            result = compute_generation(provider, model, instruction, text, data, **params)
+
+        shared_cache.set('generation', key, {**result, "speculative": True}, GENERATION_CACHE_TTL)
+        tokens = sum(result.get('usage', {}).values())
+        self.count('generated')
+        self.count('tokens', tokens)
+        shared_cache.incr('speculative', f'tokens:{int(time.time() // 3600)}', tokens, 7200)
+
+    def run(self):
+        while True:
+            job, scheduled_at = self.next_job()
+            try:
+                self.run_job(job, scheduled_at)
+            except Exception as e:
+                self.count('failed')
+                app.logger.warning("Speculative %s for %s with %s failed: %s", job[3], job[2], job[1], e)
+
+    def start(self):
+        if SPECULATIVE_ENABLED and self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='speculator', daemon=True)
+            self.thread.start()
+
+    def record_hit(self, key, cached):
+        """Count a request served by a speculative result; later hits count as ordinary cache hits"""
+        shared_cache.set('generation', key, cached, GENERATION_CACHE_TTL)
+        self.count('hits')
+
+    def stats(self):
+        names = ['scheduled', 'generated', 'hits', 'tokens', 'failed',
+                 'skipped_cached', 'skipped_busy', 'skipped_budget', 'skipped_size']
+        counters = {name: shared_cache.get('speculative', name) or 0 for name in names}
+        hour = int(time.time() // 3600)
+        with self.condition:
+            pending = len(self.pending)
+        return {
+            "enabled": SPECULATIVE_ENABLED,
+            "commands": SPECULATIVE_COMMANDS,
+            "providers": sorted(SPECULATIVE_PROVIDERS),
+            "pending": pending,
+            **counters,
+            "hit_rate": round(counters['hits'] / counters['generated'], 3) if counters['generated'] else None,
+            "this_hour": {
+                "generated": min(shared_cache.get('speculative', f'runs:{hour}') or 0, SPECULATIVE_MAX_PER_HOUR),
+                "max_generations": SPECULATIVE_MAX_PER_HOUR,
+                "tokens": shared_cache.get('speculative', f'tokens:{hour}') or 0,
+                "max_tokens": SPECULATIVE_MAX_TOKENS_PER_HOUR
+            }
+        }
 
-.prompt {
-    color: #4CAF50;
-    font-weight: bold;
-    margin-right: 8px;
-    font-family: 'Courier New', Courier, monospace;
-}
+speculator = Speculator()
 
-#terminal-input {
-    background-color: transparent;
-    border: none;
-    color: #f0f0f0;
-    flex: 1;
-    font-family: 'Courier New', Courier, monospace;
-    font-size: 13px;
-}
+# ============================================================================
+# OFFLINE BULK MODE (MESSAGE BATCHES)
+# ============================================================================
 
-#terminal-input:focus {
-    outline: none;
-}
+BATCH_ITEM_FIELDS = ('id', 'pair', 'side', 'save_to', 'write_mode', 'status', 'error',
+                     'chunks', 'usage', 'saved_to', 'save_error')
+
+def batch_result_text(message):
+    return "".join(block.text for block in message.content if block.type == "text")
+
+def batch_error_message(result):
+    """Readable reason for a batch request that did not succeed"""
+    if result.type == 'errored':
+        error = getattr(result.error, 'error', None)
+        return getattr(error, 'message', None) or str(result.error)
+    return f"Request {result.type}"
+
+def pack_batches(item_requests):
+    """Group per-item request lists into batches under the request count and size limits.
+
+    An item's chunks always go into the same batch, so the item is complete
+    as soon as that batch ends.
+    """
+    packs = []
+    current = []
+    size = 0
+    for requests_for_item in item_requests:
+        item_size = sum(len(json.dumps(r)) for r in requests_for_item)
+        if current and (len(current) + len(requests_for_item) > BATCH_MAX_REQUESTS
+                        or size + item_size > BATCH_MAX_BYTES):
+            packs.append(current)
+            current = []
+            size = 0
+        current.extend(requests_for_item)
+        size += item_size
+    if current:
+        packs.append(current)
+    return packs
+
+def create_batch_job(data):
+    """Turn a /batch request into Message Batches and return the job record.
+
+    Each item is a saved pair ("pair", optional "side") or inline "text",
+    with an optional per-item "instruction". Long texts are split with
+    plan_generation and their chunks rejoined when results arrive.
+    """
+    model = data.get('model', DEFAULT_ANTHROPIC_MODEL)
+    temperature = data.get('temperature', 1.0)
+    max_tokens = data.get('max_tokens')
+
+    raw_items = list(data.get('items') or [])
+    if data.get('all_pairs'):
+        raw_items += [{"pair": name} for name in list_pair_files()]
+    if not raw_items:
+        raise ValueError("No items to process")
+
+    job = {
+        "id": uuid.uuid4().hex,
+        "created": time.time(),
+        "model": model,
+        "status": "in_progress",
+        "batches": [],
+        "items": []
+    }
+    item_requests = []
+    for index, raw in enumerate(raw_items):
+        item = {
+            "id": str(raw.get('id') or raw.get('pair') or index),
+            "pair": raw.get('pair'),
+            "side": raw.get('side', 'original'),
+            "status": "pending",
+            "usage": {}
+        }
+        job["items"].append(item)
+        instruction = raw.get('instruction') or data.get('instruction')
+        try:
+            if not instruction:
+                raise ValueError("No instruction provided")
+            if item["pair"]:
+                original_text, new_text = read_pair(item["pair"])
+                text = (new_text if item["side"] == 'new' else original_text).strip()
+                if raw.get('save', data.get('save', False)):
+                    item["save_to"], item["write_mode"] = get_write_through({
+                        "save_to": item["pair"],
+                        "write_mode": raw.get('write_mode', data.get('write_mode', 'replace'))
+                    })
+            else:
+                text = (raw.get('text') or '').strip()
+            if not text:
+                raise ValueError("Text is empty")
+            pieces = plan_generation('anthropic', model, instruction, text, max_tokens, auto_chunk=True)
+        except FileNotFoundError:
+            item.update(status="errored", error=f"File not found: {item['pair']}")
+            continue
+        except (ValueError, PreflightError) as e:
+            item.update(status="errored", error=str(e))
+            continue
+
+        # The result can then also answer the same interactive request from the cache
+        item["cache_key"] = request_cache_key('anthropic', model, instruction, text,
+                                              {"max_tokens": max_tokens, "auto_chunk": True},
+                                              temperature=temperature)
+        item["chunks"] = len(pieces)
+        item_requests.append([
+            {
+                "custom_id": f"{index}-{chunk}",
+                "params": {
+                    "model": model,
+                    "max_tokens": plan['max_tokens'],
+                    "temperature": temperature,
+                    "messages": [{"role": "user", "content": build_prompt(instruction, piece)}]
+                }
+            }
+            for chunk, (piece, plan) in enumerate(pieces)
+        ])
 
-#terminal-input:disabled {
-    opacity: 0.5;
-}
+    client = get_anthropic_client()
+    for pack in pack_batches(item_requests):
+        indexes = sorted({int(r["custom_id"].split('-')[0]) for r in pack})
+        try:
+            with timed('upstream'):
+                batch = client.messages.batches.create(requests=pack)
+        except Exception as e:
+            for index in indexes:
+                job["items"][index].update(status="errored", error=f"Batch submission failed: {e}")
+            continue
+        job["batches"].append({"id": batch.id, "status": batch.processing_status, "requests": len(pack)})
+        for index in indexes:
+            job["items"][index]["batch"] = batch.id
+
+    if not job["batches"]:
+        job["status"] = "ended"
+        job["ended"] = time.time()
+    store_batch_job(job)
+    return job
+
+def store_batch_job(job):
+    """Save a job record along with its listing summary and, while unfinished, its polling entry.
+
+    Item responses are kept in their own 'batch_result' rows, so neither
+    listing jobs nor polling them has to decode any results.
+    """
+    shared_cache.set('batch', job["id"], job, BATCH_JOB_TTL)
+    shared_cache.set('batch_summary', job["id"], batch_summary(job), BATCH_JOB_TTL)
+    if job["status"] == 'ended':
+        shared_cache.delete('batch_active', job["id"])
+    else:
+        shared_cache.set('batch_active', job["id"], {"polled": job.get("polled", 0)}, BATCH_JOB_TTL)
+
+def batch_result_key(job_id, index):
+    return f"{job_id}:{index}"
+
+def batch_summary(job, include_results=False):
+    counts = {}
+    for item in job["items"]:
+        counts[item["status"]] = counts.get(item["status"], 0) + 1
+    summary = {
+        "id": job["id"],
+        "created": job["created"],
+        "ended": job.get("ended"),
+        "model": job["model"],
+        "status": job["status"],
+        "items": len(job["items"]),
+        "item_status": counts,
+        "batches": job["batches"]
+    }
+    if include_results:
+        summary["results"] = [
+            {**{k: item[k] for k in BATCH_ITEM_FIELDS if k in item},
+             "response": shared_cache.get('batch_result', batch_result_key(job["id"], index))
+             if item["status"] == 'succeeded' else None}
+            for index, item in enumerate(job["items"])
+        ]
+    return summary
+
+class BatchPoller:
+    """Polls submitted Message Batches and maps finished results back to their items.
+
+    Every worker runs a poller, but a job is only ever polled under its lease
+    in the shared cache, always starting from the stored record, so results
+    are never collected (or written to a pair) twice. Successful items are
+    written to their pair's _new.md when the job asked for it and stored in
+    the generation cache.
+    """
+    def __init__(self):
+        self.thread = None
+        self.polls = 0
+        self.errors = 0
+
+    def collect(self, job, batch_id):
+        client = get_anthropic_client()
+        parts = {}
+        for entry in client.messages.batches.results(batch_id):
+            index, chunk = (int(n) for n in entry.custom_id.split('-'))
+            item = job["items"][index]
+            if entry.result.type == 'succeeded':
+                message = entry.result.message
+                parts.setdefault(index, {})[chunk] = batch_result_text(message)
+                merge_usage(item["usage"], {
+                    "input_tokens": message.usage.input_tokens,
+                    "output_tokens": message.usage.output_tokens
+                })
+            else:
+                item.update(status=entry.result.type, error=batch_error_message(entry.result))
+
+        for index, item in enumerate(job["items"]):
+            if item.get("batch") != batch_id or item["status"] != "pending":
+                continue
+            chunks = parts.get(index, {})
+            if len(chunks) != item["chunks"]:
+                item.update(status="errored", error="Missing results for some chunks")
+                continue
+            response = "\n\n".join(chunks[c] for c in range(item["chunks"]))
+            shared_cache.set('batch_result', batch_result_key(job["id"], index), response, BATCH_JOB_TTL)
+            item["status"] = "succeeded"
+            if GENERATION_CACHE_TTL > 0:
+                shared_cache.set('generation', item["cache_key"], {
+                    "response": response, "usage": item["usage"], "chunks": item["chunks"]
+                }, GENERATION_CACHE_TTL)
+            if item.get("save_to"):
+                try:
+                    save_generated(item["save_to"], item["write_mode"], response)
+                    item["saved_to"] = item["save_to"]
+                except (OSError, ValueError) as e:
+                    item["save_error"] = str(e)
+
+    def poll_job(self, job_id):
+        """Refresh every unfinished batch of a job, collecting results of those that ended.
+
+        Returns the updated job, or None if another worker is polling it right now.
+        """
+        if not self.claim(job_id):
+            return None
+        try:
+            job = shared_cache.get('batch', job_id)
+            if job is not None and job["status"] != 'ended':
+                self.refresh(job)
+            return job
+        finally:
+            shared_cache.delete('batch_lease', job_id)
+
+    def refresh(self, job):
+        client = get_anthropic_client()
+        for batch in job["batches"]:
+            if batch["status"] == 'ended':
+                continue
+            with timed('upstream'):
+                remote = client.messages.batches.retrieve(batch["id"])
+            batch["status"] = remote.processing_status
+            counts = remote.request_counts
+            batch["request_counts"] = {k: getattr(counts, k) for k in
+                                       ('processing', 'succeeded', 'errored', 'canceled', 'expired')}
+            if remote.processing_status == 'ended':
+                self.collect(job, batch["id"])
+
+        statuses = {batch["status"] for batch in job["batches"]}
+        if statuses <= {'ended'}:
+            job["status"] = "ended"
+            job["ended"] = time.time()
+        elif 'canceling' in statuses:
+            job["status"] = "canceling"
+        job["polled"] = time.time()
+        store_batch_job(job)
+
+    def claim(self, job_id):
+        return shared_cache.incr('batch_lease', job_id, 1, BATCH_LEASE_TTL) == 1
+
+    def poll(self):
+        if not get_anthropic_client():
+            return
+        # Only unfinished jobs have an entry here; skip those another worker polled within the interval
+        for job_id, entry in shared_cache.items('batch_active'):
+            if time.time() - entry["polled"] < BATCH_POLL_INTERVAL - 1:
+                continue
+            try:
+                if self.poll_job(job_id) is not None:
+                    self.polls += 1
+            except Exception as e:
+                self.errors += 1
+                app.logger.warning("Polling batch job %s failed: %s", job_id, e)
+
+    def run(self):
+        while True:
+            self.poll()
+            time.sleep(BATCH_POLL_INTERVAL)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='batch-poller', daemon=True)
+            self.thread.start()
+
+    def stats(self):
+        return {"poll_interval_s": BATCH_POLL_INTERVAL, "polls": self.polls, "errors": self.errors}
+
+batch_poller = BatchPoller()
+
+@app.route('/batch', methods=['POST'])
+def create_batch():
+    """Queue many generations as Anthropic Message Batches (results arrive within 24 hours)"""
+    if not get_anthropic_client():
+        return jsonify({
+            "success": False,
+            "message": "Anthropic API key not configured"
+        })
+    try:
+        job = create_batch_job(request.json or {})
+        return jsonify({"success": True, "job": batch_summary(job)})
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)})
+    except Exception as e:
+        return jsonify({"success": False, "message": f"Error: {str(e)}"})
+
+@app.route('/batch', methods=['GET'])
+def list_batches():
+    jobs = sorted((summary for _, summary in shared_cache.items('batch_summary')),
+                  key=lambda summary: summary["created"], reverse=True)
+    return jsonify({"success": True, "jobs": jobs})
+
+@app.route('/batch/<job_id>', methods=['GET'])
+def get_batch(job_id):
+    """Job status and per-item results; ?refresh=true polls the batches now instead of waiting"""
+    job = shared_cache.get('batch', job_id)
+    if job is None:
+        return jsonify({"success": False, "message": "Batch job not found"}), 404
+    if request.args.get('refresh') == 'true' and job["status"] != 'ended' and get_anthropic_client():
+        try:
+            job = batch_poller.poll_job(job_id) or shared_cache.get('batch', job_id) or job
+        except Exception as e:
+            return jsonify({"success": False, "message": f"Error: {str(e)}"})
+    return jsonify({"success": True, "job": batch_summary(job, include_results=True)})
+
+@app.route('/batch/<job_id>/cancel', methods=['POST'])
+def cancel_batch(job_id):
+    job = shared_cache.get('batch', job_id)
+    if job is None:
+        return jsonify({"success": False, "message": "Batch job not found"}), 404
+    if not get_anthropic_client():
+        return jsonify({
+            "success": False,
+            "message": "Anthropic API key not configured"
+        })
+    try:
+        for batch in job["batches"]:
+            if batch["status"] == 'in_progress':
+                with timed('upstream'):
+                    get_anthropic_client().messages.batches.cancel(batch["id"])
+        # The poller picks up the canceling status and still collects canceled results
+        job = batch_poller.poll_job(job_id) or shared_cache.get('batch', job_id) or job
+        return jsonify({"success": True, "job": batch_summary(job)})
+    except Exception as e:
+        return jsonify({"success": False, "message": f"Error: {str(e)}"})
 
-.output-user {
-    color: #64B5F6;
-}
+# ============================================================================
+# STATS AND BACKGROUND WORKERS
+# ============================================================================
 
-.output-system {
-    color: #FFD54F;
-}
+_background_started = False
+
+def start_background_workers():
+    """Start per-process background threads; call once in each worker process"""
+    global _background_started
+    if _background_started:
+        return
+    _background_started = True
+    ollama_warmup.start()
+    speculator.start()
+    batch_poller.start()
+
+@app.route('/stats')
+def stats():
+    """Runtime statistics for this worker process"""
+    return jsonify({
+        "pid": os.getpid(),
+        "ollama_warmup": ollama_warmup.stats(),
+        "speculative": speculator.stats(),
+        "batch_poller": batch_poller.stats()
+    })
 
-.output-error {
-    color: #EF5350;
-}
+# ============================================================================
+# HEALTH CHECK
+# ============================================================================
 
-.output-success {
-    color: #4CAF50;
-}
+@app.route('/health')
+def health():
+    """Health check endpoint to verify service status"""
+    status = {
+        "anthropic": {
+            "configured": bool(ANTHROPIC_API_KEY),
+            "available": False
+        },
+        "ollama": {
+            "available": False
+        }
+    }
 
-.output-info {
-    color: #81C784;
-}
+    # Check Anthropic
+    if ANTHROPIC_API_KEY:
+        try:
+            # Quick validation - just check if client is initialized
+            status["anthropic"]["available"] = get_anthropic_client() is not None
+        except:
+            pass
 
-.loading-indicator {
-    color: #FFA726;
-    animation: pulse 1.5s ease-in-out infinite;
-}
+    # Check Ollama (shared across workers for a few seconds so probes stay cheap)
+    ollama_available = shared_cache.get('health', 'ollama')
+    if ollama_available is None:
+        ollama_available = False
+        try:
+            with timed('upstream'):
+                response = requests.get(f"{OLLAMA_BASE_URL}/tags", timeout=2)
+            ollama_available = response.status_code == 200
+        except:
+            pass
+        shared_cache.set('health', 'ollama', ollama_available, HEALTH_CACHE_TTL)
+    status["ollama"]["available"] = ollama_available
 
-@keyframes pulse {
-    0%, 100% { opacity: 1; }
-    50% { opacity: 0.5; }
-}
+    # Queue saturation, so a load balancer can steer traffic away from a full worker
+    for provider, controller in admission.items():
+        status[provider]["admission"] = controller.snapshot()
+    saturated = any(status[p]["admission"]["queue_full"] for p in admission)
+    status["saturated"] = saturated
 
-.markdown-preview h1 { font-size: 2em; margin: 0.67em 0; }
-.markdown-preview h2 { font-size: 1.5em; margin: 0.75em 0; }
-.markdown-preview h3 { font-size: 1.17em; margin: 0.83em 0; }
-.markdown-preview p { margin: 1em 0; }
-.markdown-preview code { background: #f5f5f5; padding: 2px 4px; border-radius: 3px; }
-.markdown-preview pre { background: #f5f5f5; padding: 1em; border-radius: 3px; overflow-x: auto; }
-.markdown-preview blockquote { border-left: 4px solid #ddd; margin: 1em 0; padding-left: 1em; }
-.markdown-preview ul, .markdown-preview ol { margin: 1em 0; padding-left: 2em; }
-.markdown-preview table { border-collapse: collapse; width: 100%; margin: 1em 0; }
-.markdown-preview th, .markdown-preview td { border: 1px solid #ddd; padding: 8px; }
-.markdown-preview th { background: #f5f5f5; }
-
-/* Token usage display */
-.token-usage {
-    color: #888;
-    font-size: 11px;
-    font-style: italic;
-}
-''')
+    return jsonify(status), 503 if saturated else 200
 
-    print("Starting enhanced server on http://127.0.0.1:5000/")
-    print(f"Anthropic configured: {anthropic_client is not None}")
+if __name__ == '__main__':
+    # Development server only; use `python serve.py` for production
+    print("Starting development server on http://127.0.0.1:5000/")
+    print(f"Anthropic configured: {bool(ANTHROPIC_API_KEY)}")
     print(f"Ollama URL: {OLLAMA_BASE_URL}")
+    # With the reloader, only the child process that serves requests starts workers
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_workers()
     app.run(debug=True)
@@ -0,0 +1,123 @@
+"""Local stand-in for the Anthropic Message Batches API.
+
+Lets the offline bulk mode (/batch) be exercised without an API key or
+cost. Each batch "processes" for STANDIN_DELAY seconds, then every request
+succeeds with a reply that echoes its prompt, except prompts containing
+STANDIN_ERROR, which come back errored.
+
+Usage:
+    python batch_standin.py
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8765 ANTHROPIC_API_KEY=test python app.py
+"""
+import os
+import time
+import uuid
+import json
+import threading
+from datetime import datetime, timezone
+from flask import Flask, request, jsonify, Response
+
+HOST = os.getenv("STANDIN_HOST", "127.0.0.1")
+PORT = int(os.getenv("STANDIN_PORT", "8765"))
+DELAY = float(os.getenv("STANDIN_DELAY", "5"))  # seconds before a batch ends
+
+app = Flask(__name__)
+batches = {}
+lock = threading.Lock()
+
+def timestamp(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat().replace('+00:00', 'Z')
+
+def result_for(entry, canceled):
+    if canceled:
+        return {"type": "canceled"}
+    content = entry["params"]["messages"][-1]["content"]
+    if isinstance(content, list):
+        content = "".join(block.get("text", "") for block in content)
+    if "STANDIN_ERROR" in content:
+        return {"type": "errored",
+                "error": {"type": "error", "error": {"type": "invalid_request_error",
+                                                     "message": "Stand-in error requested"}}}
+    text = f"[{entry['params']['model']}] {content}"
+    return {
+        "type": "succeeded",
+        "message": {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "type": "message",
+            "role": "assistant",
+            "model": entry["params"]["model"],
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": len(content) // 4, "output_tokens": len(text) // 4}
+        }
+    }
+
+def batch_json(batch):
+    now = time.time()
+    ended = batch["canceled_at"] is not None or now - batch["created"] >= DELAY
+    counts = {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+    if ended:
+        for entry in batch["requests"]:
+            counts[result_for(entry, batch["canceled_at"] is not None)["type"]] += 1
+    else:
+        counts["processing"] = len(batch["requests"])
+    return {
+        "id": batch["id"],
+        "type": "message_batch",
+        "processing_status": "ended" if ended else "in_progress",
+        "request_counts": counts,
+        "created_at": timestamp(batch["created"]),
+        "expires_at": timestamp(batch["created"] + 24 * 3600),
+        "ended_at": timestamp(batch["created"] + DELAY) if ended else None,
+        "cancel_initiated_at": timestamp(batch["canceled_at"]) if batch["canceled_at"] else None,
+        "archived_at": None,
+        "results_url": f"{request.host_url}v1/messages/batches/{batch['id']}/results" if ended else None
+    }
+
+def get_batch(batch_id):
+    with lock:
+        return batches.get(batch_id)
+
+def not_found():
+    return jsonify({"type": "error", "error": {"type": "not_found_error", "message": "Batch not found"}}), 404
+
+@app.route('/v1/messages/batches', methods=['POST'])
+def create():
+    entries = (request.json or {}).get("requests") or []
+    if not entries:
+        return jsonify({"type": "error", "error": {"type": "invalid_request_error",
+                                                   "message": "requests must not be empty"}}), 400
+    batch = {"id": f"msgbatch_{uuid.uuid4().hex}", "created": time.time(),
+             "canceled_at": None, "requests": entries}
+    with lock:
+        batches[batch["id"]] = batch
+    return jsonify(batch_json(batch))
+
+@app.route('/v1/messages/batches/<batch_id>', methods=['GET'])
+def retrieve(batch_id):
+    batch = get_batch(batch_id)
+    return jsonify(batch_json(batch)) if batch else not_found()
+
+@app.route('/v1/messages/batches/<batch_id>/cancel', methods=['POST'])
+def cancel(batch_id):
+    batch = get_batch(batch_id)
+    if not batch:
+        return not_found()
+    if time.time() - batch["created"] < DELAY and batch["canceled_at"] is None:
+        batch["canceled_at"] = time.time()
+    return jsonify(batch_json(batch))
+
+@app.route('/v1/messages/batches/<batch_id>/results', methods=['GET'])
+def results(batch_id):
+    batch = get_batch(batch_id)
+    if not batch:
+        return not_found()
+    canceled = batch["canceled_at"] is not None
+    lines = (json.dumps({"custom_id": entry["custom_id"], "result": result_for(entry, canceled)}) + "\n"
+             for entry in batch["requests"])
+    return Response(lines, mimetype='application/binary')
+
+if __name__ == '__main__':
+    print(f"Message Batches stand-in on http://{HOST}:{PORT}/ (batches end after {DELAY:g}s)")
+    app.run(host=HOST, port=PORT, threaded=True)
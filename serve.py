@@ -0,0 +1,57 @@
+"""Production server for TextCompare.
+
+Runs the Flask app under gunicorn (several worker processes, each with a
+thread pool) on Linux/macOS, or under waitress (threaded) on Windows.
+Settings come from the SERVER_* variables in .env.
+
+Usage:
+    python serve.py
+"""
+import os
+import sys
+from dotenv import load_dotenv
+
+load_dotenv()
+
+HOST = os.getenv("SERVER_HOST", "127.0.0.1")
+PORT = int(os.getenv("SERVER_PORT", "5000"))
+WORKERS = int(os.getenv("SERVER_WORKERS", str(min(4, (os.cpu_count() or 1) * 2 + 1))))
+THREADS = int(os.getenv("SERVER_THREADS", "8"))
+# Must exceed the 120 s upstream timeout so long generations are not killed
+TIMEOUT = int(os.getenv("SERVER_TIMEOUT", "180"))
+
+def run_gunicorn():
+    from gunicorn.app.base import BaseApplication
+
+    class TextCompareApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{HOST}:{PORT}")
+            self.cfg.set('workers', WORKERS)
+            self.cfg.set('threads', THREADS)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', TIMEOUT)
+            self.cfg.set('accesslog', '-')
+
+        def load(self):
+            # Imported in each worker after fork, so connections and
+            # background threads are never shared between processes
+            from app import app, start_background_workers
+            start_background_workers()
+            return app
+
+    TextCompareApplication().run()
+
+def run_waitress():
+    from waitress import serve
+    from app import app, start_background_workers
+    start_background_workers()
+    serve(app, host=HOST, port=PORT, threads=THREADS, channel_timeout=TIMEOUT)
+
+if __name__ == '__main__':
+    print(f"Starting production server on http://{HOST}:{PORT}/")
+    if sys.platform == 'win32':
+        print(f"waitress: {THREADS} threads")
+        run_waitress()
+    else:
+        print(f"gunicorn: {WORKERS} workers x {THREADS} threads")
+        run_gunicorn()
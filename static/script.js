@@ -53,10 +53,60 @@ document.addEventListener('DOMContentLoaded', function() {
     // Load file list on page load
     loadFileList();
 
+    // Pair whose original text is on the server unchanged, so generation
+    // requests can reference it by name instead of uploading it again
+    let savedPair = null;
+    let savedOriginal = null;
+
+    function rememberSavedPair(filename, text) {
+        savedPair = filename;
+        savedOriginal = text;
+    }
+
+    // Large documents are streamed to /save/stream one side at a time
+    const STREAM_SAVE_THRESHOLD = 1024 * 1024;
+
+    function streamSave(filename) {
+        const upload = (side, text) => fetch(
+            `/save/stream?filename=${encodeURIComponent(filename)}&side=${side}`,
+            {
+                method: 'PUT',
+                headers: {
+                    'Content-Type': 'text/markdown; charset=utf-8'
+                },
+                body: text
+            }
+        ).then(response => response.json());
+
+        const original = originalText.value;
+        return upload('original', original)
+            .then(result => {
+                if (!result.success) {
+                    return result;
+                }
+                return upload('new', newText.value).then(newResult => {
+                    if (newResult.success) {
+                        rememberSavedPair(filename, original);
+                        return { success: true, message: `Saved as ${filename}` };
+                    }
+                    return newResult;
+                });
+            });
+    }
+
     // Save button click handler
     saveBtn.addEventListener('click', function() {
         const filename = filenameInput.value || 'untitled.md';
 
+        if (originalText.value.length + newText.value.length > STREAM_SAVE_THRESHOLD) {
+            streamSave(filename).then(data => {
+                statusMessage.textContent = data.message;
+                loadFileList();
+            });
+            return;
+        }
+
+        const original = originalText.value;
         const formData = new FormData();
         formData.append('original_text', originalText.value);
         formData.append('new_text', newText.value);
@@ -69,6 +119,9 @@ document.addEventListener('DOMContentLoaded', function() {
         .then(response => response.json())
         .then(data => {
             statusMessage.textContent = data.message;
+            if (data.success) {
+                rememberSavedPair(filename, original);
+            }
             loadFileList();
         });
     });
@@ -83,6 +136,9 @@ document.addEventListener('DOMContentLoaded', function() {
 
         const formData = new FormData();
         formData.append('filename', filename);
+        // Lets the server precompute common commands with the selected model
+        formData.append('provider', currentProvider);
+        formData.append('model', currentModel);
 
         fetch('/load', {
             method: 'POST',
@@ -93,6 +149,7 @@ document.addEventListener('DOMContentLoaded', function() {
             if (data.success) {
                 originalText.value = data.original_text;
                 newText.value = data.new_text;
+                rememberSavedPair(filename, data.original_text);
                 statusMessage.textContent = `Loaded ${filename}`;
                 updateWordCount(originalText.value, originalWordCount);
                 updateWordCount(newText.value, newWordCount);
@@ -110,6 +167,8 @@ document.addEventListener('DOMContentLoaded', function() {
 
             const formData = new FormData();
             formData.append('filename', this.value);
+            formData.append('provider', currentProvider);
+            formData.append('model', currentModel);
 
             fetch('/load', {
                 method: 'POST',
@@ -120,6 +179,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 if (data.success) {
                     originalText.value = data.original_text;
                     newText.value = data.new_text;
+                    rememberSavedPair(this.value, data.original_text);
                     statusMessage.textContent = `Loaded ${this.value}`;
                     updateWordCount(originalText.value, originalWordCount);
                     updateWordCount(newText.value, newWordCount);
@@ -248,11 +308,14 @@ document.addEventListener('DOMContentLoaded', function() {
                 case 'health':
                     checkHealth();
                     break;
+                case 'tokens':
+                    countTokens();
+                    break;
                 case 'rewrite':
-                    generateText('Rewrite the following text in a clearer, more concise way. Preserve any markdown formatting:');
+                    generateText('Rewrite the following text in a clearer, more concise way. Preserve any markdown formatting:', { incremental: true });
                     break;
                 case 'improve':
-                    generateText('Improve the following text by enhancing its clarity, structure, and style. Preserve any markdown formatting:');
+                    generateText('Improve the following text by enhancing its clarity, structure, and style. Preserve any markdown formatting:', { incremental: true });
                     break;
                 case 'summarize':
                     generateText('Summarize the following text in a few sentences. Use markdown formatting for better readability:');
@@ -314,6 +377,7 @@ Available commands:
 /help - Show this help message
 /models - List available models for current provider
 /health - Check service status
+/tokens - Estimate prompt tokens for the original text with the current model
 /rewrite - Rewrite the text in the original column
 /improve - Improve the text for clarity and style
 /summarize - Summarize the text
@@ -375,6 +439,36 @@ You can also just type a question or request directly.`;
             });
     }
 
+    // Estimate token usage before sending a request
+    function countTokens() {
+        fetch('/count_tokens', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                text: originalText.value,
+                provider: currentProvider,
+                model: currentModel
+            })
+        })
+            .then(response => response.json())
+            .then(data => {
+                let message = `Estimated prompt: ${data.prompt_tokens} tokens of ${data.context_window} (${data.model})\n`;
+                message += `Output budget: ${data.max_tokens} tokens`;
+                if (data.num_ctx) {
+                    message += `, num_ctx ${data.num_ctx}`;
+                }
+                if (!data.fits) {
+                    message += `\nToo large for one request; commands will split it into ${data.chunk_count} chunks.`;
+                }
+                addTerminalMessage(message, data.fits ? 'info' : 'error');
+            })
+            .catch(error => {
+                addTerminalMessage(`Error counting tokens: ${error.message}`, 'error');
+            });
+    }
+
     // Update model list dropdown
     function updateModelList(provider) {
         modelList.innerHTML = '';
@@ -415,10 +509,33 @@ You can also just type a question or request directly.`;
     modelList.addEventListener('change', function() {
         currentModel = this.value;
         addTerminalMessage(`Switched to model: ${currentModel}`, 'system');
+        warmModel();
     });
 
-    // Generate text with AI
-    function generateText(instruction) {
+    // Ask the server to preload the selected Ollama model so the first request skips the load
+    function warmModel() {
+        if (currentProvider !== 'ollama' || !currentModel) {
+            return;
+        }
+        fetch('/ollama/warm', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ model: currentModel })
+        })
+            .then(response => response.json())
+            .then(data => {
+                if (data.scheduled) {
+                    addTerminalMessage(`Loading ${data.model} in the background...`, 'system');
+                }
+            })
+            .catch(() => {});
+    }
+
+    // Generate text with AI. Paragraph-local commands pass { incremental: true }
+    // so unchanged paragraphs are served from the server's rewrite cache.
+    function generateText(instruction, options = {}) {
         if (!currentModel) {
             addTerminalMessage('No model selected. Use /models to list available models.', 'error');
             return;
@@ -432,13 +549,23 @@ You can also just type a question or request directly.`;
 
         addTerminalMessage(`Processing with ${currentModel}...`, 'system');
 
-        callAI({
-            text: text,
+        const request = {
             instruction: instruction,
             model: currentModel,
             provider: currentProvider,
-            stream: streamToggle.checked
-        });
+            stream: streamToggle.checked,
+            auto_chunk: true,
+            incremental: Boolean(options.incremental)
+        };
+
+        // Reference the saved pair instead of re-uploading an unchanged document
+        if (savedPair && originalText.value === savedOriginal) {
+            request.pair = savedPair;
+        } else {
+            request.text = text;
+        }
+
+        callAI(request);
     }
 
     // Call AI API (unified for both streaming and non-streaming)
@@ -488,6 +615,13 @@ You can also just type a question or request directly.`;
                     );
                 }
 
+                if (result.paragraphs) {
+                    addTerminalMessage(
+                        `[Paragraphs: ${result.rewritten} rewritten, ${result.reused} reused]`,
+                        'token-usage'
+                    );
+                }
+
                 // For rewrite operations, also put the result in the new text area
                 if (data.instruction.includes('Rewrite') ||
                     data.instruction.includes('Improve') ||
@@ -539,6 +673,14 @@ You can also just type a question or request directly.`;
             body: JSON.stringify(data)
         })
         .then(response => {
+            // Overload (429/503) and size (413) errors come back as plain JSON
+            if (!response.ok) {
+                return response.json().then(result => {
+                    const retry = result.retry_after ? ` (retry in ${result.retry_after}s)` : '';
+                    throw new Error(`${result.message || `HTTP ${response.status}`}${retry}`);
+                });
+            }
+
             const reader = response.body.getReader();
             const decoder = new TextDecoder();
 
@@ -585,6 +727,13 @@ You can also just type a question or request directly.`;
                                         terminalOutput.appendChild(usageElement);
                                     }
 
+                                    if (jsonData.paragraphs) {
+                                        const paragraphElement = document.createElement('p');
+                                        paragraphElement.className = 'token-usage';
+                                        paragraphElement.textContent = `[Paragraphs: ${jsonData.rewritten} rewritten, ${jsonData.reused} reused]`;
+                                        terminalOutput.appendChild(paragraphElement);
+                                    }
+
                                     // For rewrite operations, update the new text area
                                     if (data.instruction.includes('Rewrite') ||
                                         data.instruction.includes('Improve') ||